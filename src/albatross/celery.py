@@ -1,6 +1,7 @@
 import os
 
 from celery import Celery
+from celery.signals import worker_init
 from django.conf import settings
 from dotenv import find_dotenv, load_dotenv
 
@@ -11,3 +12,13 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "albatross.settings")
 app = Celery("albatross")
 app.config_from_object("django.conf:settings")
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+@worker_init.connect
+def warm_caches(**kwargs):
+    """
+    Load the static data the aggregators use in the parent process, before
+    the pool forks, so that every child shares the one copy.
+    """
+    from archive import resources
+    resources.warm()
@@ -0,0 +1,456 @@
+"""
+A small metrics registry that speaks the Prometheus text exposition format.
+
+The collector, the Celery workers and the web servers are all separate
+processes (and usually separate containers), so there's no one place to keep
+the numbers in memory.  Instead, every process keeps its own and, every
+METRICS_FLUSH_INTERVAL seconds or so, writes a snapshot of them to
+METRICS_DIR, which lives on the volume they all share.  render() merges the
+snapshots: counters and histograms are summed across processes, while gauges
+are taken from whichever process reported them most recently, so long as
+that was within METRICS_GAUGE_TTL.
+
+Processes come and go (Celery recycles its children), so snapshots that
+haven't been written to in METRICS_SNAPSHOT_TTL are deleted.  Counters and
+histograms must never go down though, or Prometheus takes it for a reset, so
+before a snapshot is deleted, its counts are folded into a "retired"
+snapshot that's kept forever.  If the process that wrote it turns out to be
+alive after all, it only reports what it's counted since.
+
+All of the metrics are defined at the bottom of this module, so that every
+process knows about every metric, whether or not it ever updates it.
+"""
+
+import atexit
+import contextlib
+import copy
+import fcntl
+import glob
+import json
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Hidden, so that they're never mistaken for a process' snapshot
+LOCK = ".lock"
+RETIRED = ".retired.json"
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.pid = os.getpid()
+        self.last_flush = time.monotonic()
+
+        # The cumulative values in our last snapshot, and how much of what
+        # we've counted has already been retired (see .flush()).
+        self.written = {}
+        self.retired = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+
+    def check_fork(self):
+        """
+        Celery's pool forks its children from a parent that may already have
+        recorded a few things.  Those are the parent's to report, so a child
+        starts from nothing.  Must be called while holding the lock.
+        """
+        if not os.getpid() == self.pid:
+            self.pid = os.getpid()
+            self.last_flush = time.monotonic()
+            self.written = {}
+            self.retired = {}
+            for metric in self.metrics.values():
+                metric.values.clear()
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush >= settings.METRICS_FLUSH_INTERVAL:  # NOQA: E501
+            self.flush()
+
+    def flush(self):
+        """
+        Write a snapshot of this process' metrics.  We write to a hidden
+        temporary file first and rename it into place so that render() never
+        sees half a snapshot.
+
+        If our last snapshot has disappeared, render() retired it, so
+        everything in it has been counted already, and from here on we only
+        report what we've counted on top of that.
+        """
+
+        with self.lock:
+            self.check_fork()
+            self.last_flush = time.monotonic()
+            values = {
+                name: copy.deepcopy(metric.values)
+                for name, metric in self.metrics.items()
+                if metric.values
+            }
+            if not values:
+                return
+
+        name = f"{socket.gethostname()}-{self.pid}.json"
+        path = os.path.join(settings.METRICS_DIR, name)
+        tmp = os.path.join(settings.METRICS_DIR, f".{name}")
+
+        try:
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            with self.flush_lock, self._lock_directory():
+
+                if self.written and not os.path.exists(path):
+                    self._add(self.retired, self.written)
+
+                self.written = {}
+                for metric_name, current in values.items():
+                    metric = self.metrics[metric_name]
+                    if isinstance(metric, Gauge):
+                        continue
+                    retired = self.retired.get(metric_name, {})
+                    for key, value in current.items():
+                        if key in retired:
+                            current[key] = metric.subtract(
+                                value, retired[key])
+                    self.written[metric_name] = current
+
+                with open(tmp, "w") as f:
+                    json.dump({"time": time.time(), "metrics": {
+                        metric_name: list(_.items())
+                        for metric_name, _ in values.items()
+                    }}, f, separators=(",", ":"))
+                os.rename(tmp, path)
+
+        except OSError:
+            pass  # Metrics are never worth taking a process down for
+
+    def render(self):
+        """
+        Merge every process' snapshot, and return the lot in the Prometheus
+        text format.
+        """
+
+        self.flush()
+
+        merged = {name: {} for name in self.metrics}
+        now = time.time()
+
+        for snapshot in self._get_snapshots():
+            is_fresh = now - snapshot["time"] <= settings.METRICS_GAUGE_TTL
+            for name, values in snapshot["metrics"].items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                if isinstance(metric, Gauge) and not is_fresh:
+                    continue
+                for key, value in values:
+                    key = tuple(key)
+                    if key in merged[name]:
+                        value = metric.merge(merged[name][key], value)
+                    merged[name][key] = value
+
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines += metric.render(merged[name])
+
+        return "\n".join(lines) + "\n"
+
+    def _get_snapshots(self):
+        """
+        Snapshots are sorted oldest first, so the latest value of a gauge
+        wins, with the retired snapshot first of all.  Anything older than
+        METRICS_SNAPSHOT_TTL is from a process that's long gone, so it's
+        retired.
+        """
+
+        r = []
+        with self._lock_directory():
+
+            retired = self._read_snapshot(RETIRED) or {
+                "time": 0, "metrics": {}}
+            expired = []
+
+            for path in glob.glob(os.path.join(settings.METRICS_DIR, "*.json")):  # NOQA: E501
+                try:
+                    if time.time() - os.stat(path).st_mtime > settings.METRICS_SNAPSHOT_TTL:  # NOQA: E501
+                        expired.append(path)
+                        continue
+                except OSError:
+                    continue  # Deleted while we were looking at it
+                r.append(self._read_snapshot(path))
+
+            if expired:
+                self._retire(retired, expired)
+
+        r = sorted([_ for _ in r if _], key=lambda _: _["time"])
+
+        return [retired] + r
+
+    def _retire(self, retired, paths):
+        """
+        Fold the counters & histograms of the snapshots at ``paths`` into
+        the retired snapshot, and only then delete them.  Must be called
+        while holding the directory lock.
+        """
+
+        merged = {}
+        for name, values in retired["metrics"].items():
+            merged[name] = {tuple(k): v for k, v in values}
+
+        for path in paths:
+            snapshot = self._read_snapshot(path) or {"metrics": {}}
+            self._add(merged, {
+                name: {tuple(k): v for k, v in values}
+                for name, values in snapshot["metrics"].items()
+                if name in self.metrics
+                and not isinstance(self.metrics[name], Gauge)
+            })
+
+        retired["metrics"] = {
+            name: list(values.items()) for name, values in merged.items()}
+
+        path = os.path.join(settings.METRICS_DIR, RETIRED)
+        try:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(retired, f, separators=(",", ":"))
+            os.rename(f"{path}.tmp", path)
+            for path in paths:
+                os.unlink(path)
+        except OSError:
+            pass
+
+    def _add(self, totals, values):
+        """
+        Add ``values`` to ``totals``, both being dictionaries of metric name
+        → {key: value}.
+        """
+        for name, metric_values in values.items():
+            metric = self.metrics[name]
+            totals.setdefault(name, {})
+            for key, value in metric_values.items():
+                if key in totals[name]:
+                    value = metric.merge(totals[name][key], value)
+                totals[name][key] = copy.deepcopy(value)
+
+    @staticmethod
+    def _read_snapshot(path):
+        try:
+            with open(os.path.join(settings.METRICS_DIR, path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None  # Deleted or replaced while we were looking at it
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _lock_directory():
+        """
+        Serialise flushing & retiring across processes, so that a snapshot
+        is never retired while its process is deciding whether it has been.
+        """
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        with open(os.path.join(settings.METRICS_DIR, LOCK), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+registry = Registry()
+atexit.register(registry.flush)
+
+
+class Metric:
+
+    TYPE = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.register(self)
+
+    def merge(self, a, b):
+        raise NotImplementedError()
+
+    def render(self, values):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        for key, value in sorted(values.items()):
+            lines += self._render_value(key, value)
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{self._format_labels(key)} {value}"]
+
+    def _update(self, labels, function):
+        key = tuple(str(labels[_]) for _ in self.labels)
+        with registry.lock:
+            registry.check_fork()
+            self.values[key] = function(self.values.get(key))
+        registry.maybe_flush()
+
+    def _format_labels(self, key, **extra):
+        pairs = list(zip(self.labels, key)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(
+            f'{k}="{self._escape(v)}"' for k, v in pairs) + "}"
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace(
+            "\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter(Metric):
+
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._update(labels, lambda _: (_ or 0) + amount)
+
+    def merge(self, a, b):
+        return a + b
+
+    def subtract(self, a, b):
+        return a - b
+
+
+class Gauge(Metric):
+
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        self._update(labels, lambda _: value)
+
+    def clear(self):
+        with registry.lock:
+            self.values.clear()
+
+    def merge(self, a, b):
+        return b
+
+
+class Histogram(Metric):
+    """
+    Values are kept as [<count per bucket>, <sum>, <count>], where the
+    counts per bucket aren't cumulative until they're rendered.
+    """
+
+    TYPE = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+
+        def update(current):
+            if current is None:
+                current = [[0] * (len(self.buckets) + 1), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            current[0][i] += 1
+            current[1] += value
+            current[2] += 1
+            return current
+
+        self._update(labels, update)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def merge(self, a, b):
+        return [
+            [x + y for x, y in zip(a[0], b[0])],
+            a[1] + b[1],
+            a[2] + b[2]
+        ]
+
+    def subtract(self, a, b):
+        return [
+            [x - y for x, y in zip(a[0], b[0])],
+            a[1] - b[1],
+            a[2] - b[2]
+        ]
+
+    def _render_value(self, key, value):
+
+        counts, total, count = value
+
+        r = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + ("+Inf",), counts):
+            cumulative += n
+            labels = self._format_labels(key, le=bound)
+            r.append(f"{self.name}_bucket{labels} {cumulative}")
+        r.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+        r.append(f"{self.name}_count{self._format_labels(key)} {count}")
+
+        return r
+
+
+TWEETS_INGESTED = Counter(
+    "albatross_tweets_ingested_total",
+    "Tweets matched to an archive by the collector",
+    labels=("archive",)
+)
+BUFFER_DEPTH = Gauge(
+    "albatross_buffer_depth",
+    "Tweets waiting in the collector's buffer for an archive",
+    labels=("archive",)
+)
+BATCH_FLUSH_DURATION = Histogram(
+    "albatross_batch_flush_seconds",
+    "Time taken by the collector to hand a batch off to the workers"
+)
+BATCH_SIZE = Histogram(
+    "albatross_batch_tweets",
+    "Tweets per batch handed off to the workers",
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+)
+BATCH_TARGET_SIZE = Gauge(
+    "albatross_batch_target_tweets",
+    "The batch size the collector is currently aiming for, per archive",
+    labels=("archive",)
+)
+BATCH_WINDOW = Gauge(
+    "albatross_batch_window_seconds",
+    "The longest the collector will currently hold a batch, per archive",
+    labels=("archive",)
+)
+TASK_QUEUE_LAG = Histogram(
+    "albatross_task_queue_lag_seconds",
+    "Time between a batch being dispatched and a worker starting on it",
+    labels=("type",)
+)
+AGGREGATOR_DURATION = Histogram(
+    "albatross_aggregator_duration_seconds",
+    "Time spent in each phase of an aggregator's work",
+    labels=("type", "phase")
+)
+DISTILLATION_AGE = Gauge(
+    "albatross_distillation_age_seconds",
+    "Time since a running archive's distillation was last generated",
+    labels=("archive", "kind")
+)
@@ -9,8 +9,10 @@ from archive.views import (
     ArchiveDetailView,
     ArchiveDistillationView,
     ArchiveListView,
+    ArchiveSegmentsView,
     ArchiveSubsetView,
-    IndexView
+    IndexView,
+    MetricsView
 )
 
 urlpatterns = [
@@ -22,6 +24,7 @@ urlpatterns = [
         TemplateView.as_view(template_name="albatross/about.html"),
         name="about"
     ),
+    url(r'^metrics$', MetricsView.as_view(), name="metrics"),
     url(
         r'^archives/(?P<pk>\d+)/text/',
         DetailView.as_view(
@@ -78,4 +81,9 @@ urlpatterns += format_suffix_patterns([
         ArchiveSubsetView.as_view(),
         name="archives-subset"
     ),
+    url(
+        r'^api/archives/(?P<pk>\d+)/segments$',
+        ArchiveSegmentsView.as_view(),
+        name="archives-segments"
+    ),
 ])
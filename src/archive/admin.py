@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Archive, Event
+from .models import Archive, ArchiveSegment, ArchiveSegmentSummary, Event
 
 
 class ArchiveAdmin(admin.ModelAdmin):
@@ -19,6 +19,32 @@ class ArchiveAdmin(admin.ModelAdmin):
 admin.site.register(Archive, ArchiveAdmin)
 
 
+class ArchiveSegmentAdmin(admin.ModelAdmin):
+    list_display = (
+        "archive", "type", "start_time", "claim_time", "stop_time",
+        "is_final", "tweets", "collect_duration", "generate_duration",
+        "bytes_written", "files_written"
+    )
+    list_filter = ("type", "is_final", "archive")
+    readonly_fields = (
+        "tweets", "collect_duration", "generate_duration", "bytes_written",
+        "files_written"
+    )
+
+admin.site.register(ArchiveSegment, ArchiveSegmentAdmin)
+
+
+class ArchiveSegmentSummaryAdmin(admin.ModelAdmin):
+    list_display = (
+        "archive", "type", "segments", "tweets", "collect_duration",
+        "generate_duration", "max_collect_duration", "max_generate_duration",
+        "bytes_written", "files_written", "created"
+    )
+    list_filter = ("type", "archive")
+
+admin.site.register(ArchiveSegmentSummary, ArchiveSegmentSummaryAdmin)
+
+
 class EventAdmin(admin.ModelAdmin):
     list_display = ("label", "archive", "time")
     list_filter = ("archive",)
@@ -1,15 +1,28 @@
+import collections
 import copy
+import fcntl
 import glob
 import json
-import lzma
 import os
 import shutil
 import uuid
+from contextlib import contextmanager
 
 from django.conf import settings
 
 from albatross.logging import LogMixin
 
+from .. import compression
+from ..settings import BUCKET_SIZE, SKETCH_ERROR
+from ..sketches import SpaceSaving
+from ..tweets import (
+    get_language,
+    get_origin,
+    get_timestamp,
+    get_url,
+    normalise
+)
+
 
 class Aggregator(LogMixin):
 
@@ -17,6 +30,9 @@ class Aggregator(LogMixin):
 
     DEFAULT_AGGREGATE = None
 
+    LOCK = ".lock"
+    COMPACTION_THRESHOLD = 10  # Deltas to accumulate before compacting
+
     def __init__(self, archive):
 
         self.archive = archive
@@ -24,48 +40,259 @@ class Aggregator(LogMixin):
         self.cache_dir = os.path.join(
             self.CACHE_DIR,
             str(archive.pk),
-            self.__class__.__name__.lower().replace("aggregator", "")
+            self.get_type()
         )
 
-        os.makedirs(self.cache_dir, exist_ok=True)
+        # What we've written to disk, for the segment instrumentation
+        self.bytes_written = 0
+        self.files_written = 0
 
         self.logger.debug("Aggregate logger using %s ready", self.cache_dir)
 
+    @classmethod
+    def get_type(cls):
+        return cls.__name__.lower().replace("aggregator", "")
+
     def write_cache(self, aggregate):
         """
-        Write aggregate data to disk.  This is later picked up in
-        ``.read_cache()``.
+        Write aggregate data to disk as a delta file.  This is later picked up
+        in ``.read_cache()``.
         """
 
-        path = os.path.join(self.cache_dir, f"{uuid.uuid4()}.json.xz")
+        self.logger.info(
+            "Writing aggregate for %s to %s", self.archive, self.cache_dir)
 
-        self.logger.info("Writing aggregate for %s to %s", self.archive, path)
-
-        with lzma.open(path, "wb") as f:
-            f.write(
-                bytes(json.dumps(aggregate, separators=(",", ":")), "UTF-8")
-            )
+        self._write_delta(self.cache_dir, aggregate)
 
     def read_cache(self):
         """
-        Return a complete aggregate from all the cache files on-disk, including
-        the one recently generated in this pass.
-        """
+        Return a complete aggregate from the snapshot on-disk plus any delta
+        files written since, including the one recently generated in this
+        pass.
 
-        aggregate = copy.deepcopy(self.DEFAULT_AGGREGATE)
+        Once enough deltas have piled up, they're folded into the snapshot and
+        deleted, so the cost of this call is bounded by the size of the
+        aggregate rather than the number of batches the archive has seen.
+        """
 
         self.logger.info(
             "Reading aggregate for %s from %s", self.archive, self.cache_dir)
 
-        for path in glob.glob(os.path.join(self.cache_dir, "*")):
-            with lzma.open(path, "rb") as f:
-                self.update_aggregate(
-                    aggregate,
-                    json.loads(f.read())
+        return self._read_deltas(self.cache_dir)
+
+    def restore_cache(self):
+        """
+        Rebuild the cache of an archive that's already been finalised, so that
+        a late batch (see tasks._open_segment()) is added to everything that
+        came before it, rather than replacing it.
+        """
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        with self._lock(self.cache_dir):
+
+            # Either it was never cleared, or someone beat us to it
+            if glob.glob(os.path.join(self.cache_dir, "*")):
+                return
+
+            aggregate = self._get_finalised_aggregate()
+            if aggregate is not None:
+                self.logger.info(
+                    "Restoring the aggregate for %s to %s",
+                    self.archive,
+                    self.cache_dir
                 )
+                self.write_cache(aggregate)
+
+    def _get_finalised_aggregate(self):
+        """
+        What's left of the aggregate once the cache is gone, or None if
+        there's nothing.  By default, that's whatever's in the buckets.
+        """
+        if self._get_buckets():
+            return self.read_range()
+        return None
+
+    def collect_by_bucket(self, tweets):
+        """
+        For aggregators that keep time-bucketed aggregates: split ``tweets``
+        (NormalisedTweets) up by bucket, build a partial aggregate for each
+        with .aggregate(), write those out, and return them all merged
+        together for the cache.
+        """
+
+        batches = collections.defaultdict(list)
+        for tweet in tweets:
+            batches[tweet.timestamp - tweet.timestamp % BUCKET_SIZE].append(
+                tweet)
+
+        buckets = {start: self.aggregate(_) for start, _ in batches.items()}
+        self.write_buckets(buckets)
+
+        r = copy.deepcopy(self.DEFAULT_AGGREGATE)
+        for aggregate in buckets.values():
+            self.update_aggregate(r, aggregate)
+
+        return r
+
+    def write_buckets(self, buckets):
+        """
+        Write a delta for each of ``buckets``, a dictionary of partial
+        aggregates keyed by the start of the BUCKET_SIZE window they cover.
+        """
+        for start, aggregate in buckets.items():
+            self._write_delta(self._get_bucket_dir(start), aggregate)
+
+    def read_range(self, since=None, until=None):
+        """
+        Return an aggregate of everything between two datetimes by merging
+        only the buckets that overlap the window.  The window is effectively
+        widened to the nearest bucket boundaries.
+        """
+
+        aggregate = copy.deepcopy(self.DEFAULT_AGGREGATE)
+
+        start = since.timestamp() if since else float("-inf")
+        end = until.timestamp() if until else float("inf")
+
+        for bucket in self._get_buckets():
+            if bucket + BUCKET_SIZE <= start or bucket >= end:
+                continue
+            self.update_aggregate(
+                aggregate, self._read_deltas(self._get_bucket_dir(bucket)))
 
         return aggregate
 
+    def compact_buckets(self):
+        """
+        Fold whatever deltas are left in each bucket into its snapshot, so
+        that a finished archive has one file per bucket.
+        """
+        for bucket in self._get_buckets():
+            self._read_deltas(self._get_bucket_dir(bucket), compact=True)
+
+    def clear_buckets(self):
+        shutil.rmtree(
+            os.path.join(self.archive.get_buckets_dir(), self.get_type()),
+            ignore_errors=True
+        )
+
+    def _get_buckets(self):
+        directory = os.path.join(
+            self.archive.get_buckets_dir(), self.get_type())
+        try:
+            return sorted(int(_) for _ in os.listdir(directory))
+        except FileNotFoundError:
+            return []
+
+    def _get_bucket_dir(self, start):
+        return os.path.join(
+            self.archive.get_buckets_dir(), self.get_type(), str(start))
+
+    def _write_delta(self, directory, aggregate):
+        """
+        We write to a hidden temporary file first and rename it into place so
+        that a concurrent reader never sees a half-written delta.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+
+        name = f"{uuid.uuid4()}.json{compression.get_extension('cache')}"
+        tmp = os.path.join(directory, f".{name}")
+
+        self._write_aggregate(tmp, aggregate)
+        self._count_written(tmp)
+        os.rename(tmp, os.path.join(directory, name))
+
+    def _read_deltas(self, directory, compact=False):
+        """
+        Merge the snapshot and deltas in ``directory`` into one aggregate,
+        compacting them if there are enough of them (or we're told to).
+        """
+
+        aggregate = copy.deepcopy(self.DEFAULT_AGGREGATE)
+
+        if not os.path.isdir(directory):
+            return aggregate
+
+        snapshot = self._get_snapshot(directory)
+
+        with self._lock(directory):
+
+            if os.path.exists(snapshot):
+                self.update_aggregate(
+                    aggregate, self._read_aggregate(snapshot))
+
+            deltas = [
+                path for path in glob.glob(os.path.join(directory, "*"))
+                if not path == snapshot
+            ]
+            for path in deltas:
+                self.update_aggregate(aggregate, self._read_aggregate(path))
+
+            if deltas and (compact or len(deltas) >= self.COMPACTION_THRESHOLD):  # NOQA: E501
+                self._compact(snapshot, aggregate, deltas)
+
+        return aggregate
+
+    def _compact(self, snapshot, aggregate, deltas):
+        """
+        Replace the snapshot with the aggregate we just built and drop the
+        deltas that went into it.  This must only be called while holding the
+        lock.
+        """
+
+        self.logger.info(
+            "Compacting %s deltas for %s into %s",
+            len(deltas),
+            self.archive,
+            snapshot
+        )
+
+        tmp = os.path.join(
+            os.path.dirname(snapshot), f".{os.path.basename(snapshot)}")
+        self._write_aggregate(tmp, aggregate)
+        self._count_written(tmp)
+        os.rename(tmp, snapshot)
+
+        for path in deltas:
+            os.unlink(path)
+
+    def _count_written(self, path):
+        self.bytes_written += os.stat(path).st_size
+        self.files_written += 1
+
+    @staticmethod
+    def _get_snapshot(directory):
+        return os.path.join(
+            directory, f"snapshot.json{compression.get_extension('cache')}")
+
+    @contextmanager
+    def _lock(self, directory):
+        """
+        Serialise readers of a cache dir across workers so that two
+        compactions can't stomp on each other.  Writers don't need the lock,
+        as deltas appear atomically.
+        """
+        with open(os.path.join(directory, self.LOCK), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write_aggregate(path, aggregate):
+        with compression.open(path, "wb", "cache") as f:
+            f.write(
+                bytes(json.dumps(aggregate, separators=(",", ":")), "UTF-8")
+            )
+
+    @staticmethod
+    def _read_aggregate(path):
+        with compression.open(path, "rb") as f:
+            return json.loads(f.read())
+
     def clear_cache(self):
         """
         Remove the cache files.  The various try/except blocks are there to
@@ -81,12 +308,12 @@ class Aggregator(LogMixin):
 
         parent = os.path.dirname(self.cache_dir)
 
-        if not os.listdir(parent):
-            try:
+        try:
+            if not os.listdir(parent):
                 self.logger.info("Clearing out parent dir: %s", parent)
                 shutil.rmtree(parent)
-            except FileNotFoundError:
-                pass
+        except FileNotFoundError:
+            pass
 
     def update_aggregate(self, aggregate, addendum):
         if isinstance(aggregate, dict):
@@ -104,72 +331,98 @@ class Aggregator(LogMixin):
             primary[key] += update[key]
 
     @classmethod
-    def get_complete_text(cls, tweet):
+    def update_aggregate_counter(cls, primary, update):
         """
-        Twitter likes to strictly define `text` as 280characters, which means
-        that if a tweet is retweeted or quoted, the text of the tweet is
-        mangled to contain things like a prefixed `RT ` and a suffixed `...`.
-        This is how we can always be sure we get the actual text of the tweet
-        in question.
+        Like .update_aggregate_dict(), but for counters that may have been
+        turned into SpaceSaving sketches by .sketch().  If either side is a
+        sketch, so is the result.
         """
 
-        if "retweeted_status" in tweet:
-            return cls.get_complete_text(tweet["retweeted_status"])
+        if not SpaceSaving.is_serialised(primary):
+            if not SpaceSaving.is_serialised(update):
+                return cls.update_aggregate_dict(primary, update)
 
-        if "quoted_status" in tweet:
-            return cls.get_complete_text(tweet["quoted_status"])
-
-        return tweet["text"]
+        merged = SpaceSaving.load(primary).merge(SpaceSaving.load(update))
+        primary.clear()
+        primary.update(merged.dump())
 
     @staticmethod
-    def get_language(tweet):
+    def sketch(counts, minimum=0):
         """
-        Twitter has a very strange way of identifying languages
+        If SKETCH_ERROR is set, reduce a dictionary of exact counts to a
+        serialised SpaceSaving sketch, keeping at least ``minimum`` counters.
+        Otherwise, leave it be.
         """
 
-        r = tweet.get("lang") or tweet["user"].get("lang")
-
-        if not r or r in ("in", "enen", "enes", "fil"):
-            r = "und"
+        if SKETCH_ERROR is None:
+            return counts
 
-        r = r.lower()
-        if r in ("en-gb",):
-            r = "en"
-        if r in ("zh-cn",):
-            r = "zh"
+        capacity = SpaceSaving.get_capacity(SKETCH_ERROR, minimum)
 
-        return r
+        return SpaceSaving.from_counts(counts, capacity).dump()
 
-    @classmethod
-    def get_original_user(cls, tweet):
+    @staticmethod
+    def get_counts(counter):
+        """
+        Return a plain dictionary of counts for a counter that may or may not
+        be a sketch.  For sketches, anything that didn't make the cut is
+        lumped into "*".
+        """
 
-        if "retweeted_status" in tweet:
-            return cls.get_original_user(tweet["retweeted_status"])
+        if not SpaceSaving.is_serialised(counter):
+            return counter
 
-        if "quoted_status" in tweet:
-            return cls.get_original_user(tweet["quoted_status"])
+        sketch = SpaceSaving.load(counter)
+        r = sketch.counts()
+        r["*"] = max(sketch.total - sum(r.values()), 0)
 
-        return tweet["user"]["screen_name"]
+        return r
 
-    @classmethod
-    def get_url(cls, tweet):
+    # The per-tweet helpers live in archive.tweets, where NormalisedTweet can
+    # use them too.
+    normalise = staticmethod(normalise)
+    get_language = staticmethod(get_language)
+    get_timestamp = staticmethod(get_timestamp)
+    get_url = staticmethod(get_url)
 
-        if "retweeted_status" in tweet:
-            return cls.get_url(tweet["retweeted_status"])
+    @staticmethod
+    def get_complete_text(tweet):
+        """
+        Twitter likes to strictly define `text` as 280characters, which means
+        that if a tweet is retweeted or quoted, the text of the tweet is
+        mangled to contain things like a prefixed `RT ` and a suffixed `...`.
+        This is how we can always be sure we get the actual text of the tweet
+        in question.
+        """
+        return get_origin(tweet)["text"]
 
-        if "quoted_status" in tweet:
-            return cls.get_url(tweet["quoted_status"])
+    @staticmethod
+    def get_original_user(tweet):
+        return get_origin(tweet)["user"]["screen_name"]
 
-        return "https://twitter.com/{}/status/{}".format(
-            tweet["user"]["screen_name"],
-            tweet["id"]
-        )
+    def collect(self, tweets):
+        """
+        ``tweets`` is a list of NormalisedTweets.  Normalise them once with
+        .normalise() and pass the same list to every aggregator.
+        """
+        raise NotImplementedError("Must be defined by subclass")
 
-    def collect(self, tweet):
+    def aggregate(self, tweets):
+        """
+        Return a partial aggregate for ``tweets``.  Only required for
+        aggregators that use .collect_by_bucket().
+        """
         raise NotImplementedError("Must be defined by subclass")
 
     def generate(self):
         pass
 
+    def distil(self, aggregate):
+        """
+        Reduce a complete aggregate to the distillation we store and serve.
+        """
+        raise NotImplementedError("Must be defined by subclass")
+
     def finalise(self):
+        self.compact_buckets()
         self.clear_cache()
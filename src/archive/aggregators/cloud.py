@@ -4,6 +4,7 @@ import re
 
 from django.utils import timezone
 
+from ..sketches import SpaceSaving
 from .base import Aggregator
 
 
@@ -11,6 +12,8 @@ class CloudAggregator(Aggregator):
 
     DEFAULT_AGGREGATE = {}
 
+    TOP = 500  # The number of words in the cloud
+
     BUCKETS = 300
     BUCKET_SIZES = range(10, 310)
 
@@ -51,38 +54,51 @@ class CloudAggregator(Aggregator):
         self.query_regex = re.compile(re.escape(archive.query), re.IGNORECASE)
 
     def collect(self, tweets):
+        self.write_cache(self.collect_by_bucket(tweets))
+
+    def aggregate(self, tweets):
 
         aggregate = copy.deepcopy(self.DEFAULT_AGGREGATE)
 
         for tweet in tweets:
 
-            text = self.query_regex.sub("", self.get_complete_text(tweet))
+            text = self.query_regex.sub("", tweet.lower_text)
+            stop_words = self._get_stop_words(tweet.language)
 
             for word in text.split():
 
-                word = self.ANTI_PUNCTUATION_REGEX.sub(
-                    "", word.lower()).strip()
+                word = self.ANTI_PUNCTUATION_REGEX.sub("", word).strip()
 
-                stop_words = self._get_stop_words(self.get_language(tweet))
                 if word and word not in stop_words:
                     if "http" not in word:
                         if word not in aggregate:
                             aggregate[word] = 0
                         aggregate[word] += 1
 
-        self.write_cache(aggregate)
+        return self.sketch(aggregate, self.TOP * 2)
 
     def generate(self):
 
-        aggregate = self.read_cache()
+        cloud = self.distil(self.read_cache())
+        if cloud is None:
+            return
+
+        self.archive.cloud = json.dumps(cloud, separators=(",", ":"))
+        self.archive.cloud_generated = timezone.now()
+        self.archive.save(update_fields=("cloud", "cloud_generated"))
+
+    def distil(self, aggregate):
+
+        if SpaceSaving.is_serialised(aggregate):
+            aggregate = SpaceSaving.load(aggregate).counts()
 
         # Since we need a min & max, we kick any index less than 2.
         if len(list(aggregate.keys())) < 2:
-            return
+            return None
 
         # Sort and reduce the aggregate
         index = sorted(
-            aggregate.items(), key=lambda _: _[1], reverse=True)[1:500]
+            aggregate.items(), key=lambda _: _[1], reverse=True)[1:self.TOP]
 
         frequency_max = index[0][1]
         frequency_min = index[-1][1]
@@ -96,12 +112,10 @@ class CloudAggregator(Aggregator):
                 "size": self.BUCKET_SIZES[bucket]
             })
 
-        self.archive.cloud = json.dumps(cloud, separators=(",", ":"))
-        self.archive.cloud_generated = timezone.now()
-        self.archive.save(update_fields=("cloud", "cloud_generated"))
+        return cloud
 
     def update_aggregate(self, aggregate, addendum):
-        self.update_aggregate_dict(aggregate, addendum)
+        self.update_aggregate_counter(aggregate, addendum)
 
     def _get_stop_words(self, language):
         return self.STOP_WORDS["*"] + self.STOP_WORDS.get(language, [])
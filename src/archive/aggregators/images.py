@@ -12,6 +12,9 @@ class ImagesAggregator(Aggregator):
     DEFAULT_AGGREGATE = {}
 
     def collect(self, tweets):
+        self.write_cache(self.collect_by_bucket(tweets))
+
+    def aggregate(self, tweets):
         """
         I'm not sure why I have url in there twice, but I'm leaving it for now.
         """
@@ -19,36 +22,35 @@ class ImagesAggregator(Aggregator):
         aggregate = copy.deepcopy(self.DEFAULT_AGGREGATE)
 
         for tweet in tweets:
-            if "entities" in tweet:
-                if "media" in tweet["entities"]:
-                    for media in tweet["entities"]["media"]:
-                        if media["type"] in ("photo", "animated_gif"):
-                            image = media["media_url_https"]
-                            if "video_thumb" not in image:
-                                if image not in aggregate:
-                                    aggregate[image] = {
-                                        "total": 0,
-                                        "url": self.get_url(tweet),
-                                        "users": []
-                                    }
-                                aggregate[image]["total"] += 1
-                                aggregate[image]["users"].append(
-                                    tweet["user"]["screen_name"]
-                                )
-
-        self.write_cache(aggregate)
+            if "media" in tweet.entities:
+                for media in tweet.entities["media"]:
+                    if media["type"] in ("photo", "animated_gif"):
+                        image = media["media_url_https"]
+                        if "video_thumb" not in image:
+                            if image not in aggregate:
+                                aggregate[image] = {
+                                    "total": 0,
+                                    "url": tweet.url,
+                                    "users": []
+                                }
+                            aggregate[image]["total"] += 1
+                            aggregate[image]["users"].append(
+                                tweet.screen_name)
+
+        return aggregate
 
     def generate(self):
 
-        aggregate = self.read_cache()
-
         self.archive.images = json.dumps(
-            self._calculate_image_weight(aggregate),
+            self.distil(self.read_cache()),
             separators=(",", ":")
         )
         self.archive.images_generated = timezone.now()
         self.archive.save(update_fields=("images", "images_generated"))
 
+    def distil(self, aggregate):
+        return self._calculate_image_weight(aggregate)
+
     def update_aggregate(self, aggregate, addendum):
         for url, properties in addendum.items():
             if url not in aggregate:
@@ -70,6 +72,11 @@ class ImagesAggregator(Aggregator):
             if data["total"] > threshold:
                 r[url] = data
 
+        # Nothing's been shared more than the others, so we just take any
+        # 300 rather than none at all.
+        if not r:
+            return dict(list(images.items())[:300])
+
         return self._reduce_images(r, threshold + 1)
 
     def _calculate_image_weight(self, images):
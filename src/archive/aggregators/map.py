@@ -1,8 +1,8 @@
 import json
-import lzma
 
 from django.utils import timezone
 
+from .. import compression
 from .base import Aggregator
 
 
@@ -20,7 +20,7 @@ class MapAggregator(Aggregator):
 
         for tweet in tweets:
             try:
-                aggregate.append(self._get_refined_data(tweet))
+                aggregate.append(self._get_refined_data(tweet.data))
             except NoCoordinatesFound:
                 pass
 
@@ -30,16 +30,29 @@ class MapAggregator(Aggregator):
 
         aggregate = self.read_cache()
 
-        with lzma.open(self.archive.get_map_path(), "wb") as f:
+        path = self.archive.get_map_path(for_writing=True)
+        with compression.open(path, "wb", "map") as f:
             f.write(bytes(json.dumps(
                 aggregate,
                 separators=(",", ":"),
                 sort_keys=True
             ), "UTF-8"))
 
+        self._count_written(path)
+
         self.archive.map_generated = timezone.now()
         self.archive.save(update_fields=("map_generated",))
 
+    def _get_finalised_aggregate(self):
+        """
+        The map is written out in full every time, so it has everything.
+        """
+        try:
+            with compression.open(self.archive.get_map_path(), "rb") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+
     def _get_refined_data(self, tweet):
 
         if "coordinates" not in tweet:
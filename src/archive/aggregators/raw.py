@@ -1,11 +1,14 @@
-import datetime
 import glob
 import json
-import lzma
 import os
 import re
+import shutil
+import time
 import uuid
 
+from .. import compression
+from ..settings import RAW_BLOCK_SIZE, RAW_FINALISE
+from ..tweets import NormalisedTweet
 from .base import Aggregator
 
 
@@ -14,43 +17,261 @@ class RawAggregator(Aggregator):
     The component that actually writes the raw data to the archive file.
     """
 
-    def collect(self, tweets):
+    def collect(self, tweets, lines=None):
         """
         As we're not dealing with a python aggregate, but rather a list of
         strings we want to store as one big list, we don't call .write_cache()
         here.  Instead we roll our own.
+
+        If we've been given ``lines``, the original JSON strings for
+        ``tweets``, we write those as-is rather than re-encoding the tweets.
+
+        Each segment is also a ready-made block for the final archive, so we
+        describe it in a small sidecar file that finalise() can use to build
+        the index without having to decompress anything.
         """
 
         if not tweets:
             return
 
-        first_tweet_time = datetime.datetime.strptime(
-            tweets[0]["created_at"],
-            "%a %b %d %H:%M:%S +0000 %Y"
-        ).isoformat()
+        first_tweet_time = time.strftime(
+            "%Y%m%dT%H%M%S", time.gmtime(tweets[0].timestamp))
+
+        key = first_tweet_time + str(uuid.uuid4())
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(
+            self.cache_dir, f"{key}.fjson{compression.get_extension('raw')}")
+        if lines is None:
+            lines = [json.dumps(_.data, separators=(",", ":")) for _ in tweets]
+
+        with compression.open(path, "wb", "raw") as f:
+            for line in lines:
+                f.write(bytes(line, "UTF-8") + b"\n")
 
-        key = re.sub(r"[^\w]", "", first_tweet_time) + str(uuid.uuid4())
-        path = os.path.join(self.cache_dir, f"{key}.fjson.xz")
-        with lzma.open(path, "wb") as f:
-            for tweet in tweets:
-                f.write(bytes(
-                    json.dumps(tweet, separators=(",", ":")), "UTF-8"
-                ) + b"\n")
+        sidecar = os.path.join(self.cache_dir, f"{key}.idx.json")
+        with open(sidecar, "w") as f:
+            json.dump(self._describe(tweets), f, separators=(",", ":"))
+
+        self._count_written(path)
+        self._count_written(sidecar)
 
         self.archive.size = 0
-        for f in os.listdir(self.cache_dir):
-            self.archive.size += os.stat(
-                os.path.join(self.cache_dir, f)
-            ).st_size
+        for f in self._get_segments():
+            self.archive.size += os.stat(f).st_size
 
         self.archive.save(update_fields=("size",))
 
     def finalise(self):
+        """
+        Roll the cache segments up into the final archive.  The archive is a
+        series of independent xz streams (blocks), with a sidecar index of
+        where each one starts along with the time and id ranges it covers.
+        The result is still a perfectly normal compressed file (xz, gzip and
+        zstd all allow concatenated streams), but Archive.get_tweets() can use
+        the index to seek straight to the blocks it needs.
 
-        with lzma.open(self.archive.get_raw_path(), "wb") as w:
-            for path in glob.glob(os.path.join(self.cache_dir, "*")):
-                with lzma.open(path, "rb") as r:
-                    w.write(r.read())
-                os.unlink(path)
+        How we get there depends on RAW_FINALISE:
+
+        * "stitch": The segments are already compressed streams, so we just
+          concatenate them, in chronological order, byte-for-byte.  This is
+          quick, but leaves us with lots of small blocks, so we schedule a
+          compact() for later.
+        * "recompress": Decompress everything and re-block it into
+          RAW_BLOCK_SIZE tweets per block.  Better compression, but expensive
+          for large archives.
+
+        An archive can be finalised more than once (a duplicate final batch,
+        or a late one), so anything already in the archive is kept, and new
+        segments are added after it.  If there aren't any new segments, the
+        archive is left alone entirely.  Either way, the new archive is
+        written alongside the old one and only swapped in once it's done.
+        """
+
+        segments = self._get_segments()
+        raw = self.archive.get_raw_path()
+        existing = [raw] if os.path.exists(raw) else []
+
+        # Streams from different codecs can't share a file, so if the codec's
+        # changed since the archive was written, we have to recompress.
+        is_stitchable = RAW_FINALISE == "stitch" and \
+            raw == self.archive.get_raw_path(for_writing=True)
+
+        if existing and not segments and \
+                os.path.exists(self.archive.get_index_path()):
+            self.logger.info("Nothing new to add to %s", raw)
+        elif is_stitchable:
+            self._stitch(segments)
+        else:
+            self._recompress(existing + segments)
 
         super().finalise()
+
+    def compact(self):
+        """
+        Re-block a stitched archive in place.  This is the expensive part of
+        finalisation that we deferred, so it's meant to be run from a
+        low-priority queue (see archive.tasks.compact).
+        """
+
+        raw = self.archive.get_raw_path()
+        if not os.path.exists(raw):
+            return
+
+        self.logger.info("Compacting %s", raw)
+
+        self._recompress([raw])
+
+    def _stitch(self, segments):
+        """
+        Concatenate ``segments`` onto the end of whatever's already in the
+        archive.
+        """
+
+        raw = self.archive.get_raw_path()
+        index = []
+        sidecars = []
+
+        with open(f"{raw}.tmp", "wb") as w:
+
+            if os.path.exists(raw):
+                with open(raw, "rb") as r:
+                    shutil.copyfileobj(r, w)
+                index = self.archive.get_block_index()
+                if index is None and w.tell():
+                    entry = self._describe([])  # Legacy, so unindexed
+                    entry.update({"tweets": None, "offset": 0})
+                    entry["length"] = w.tell()
+                    index = [entry]
+                index = index or []
+
+            for path in segments:
+                sidecar = re.sub(r"\.fjson(\.\w+)?$", ".idx.json", path)
+                try:
+                    with open(sidecar) as f:
+                        entry = json.load(f)
+                    sidecars.append(sidecar)
+                except FileNotFoundError:
+                    entry = self._describe([])  # Backfilled data, or legacy
+                    entry["tweets"] = None
+                entry["offset"] = w.tell()
+                with open(path, "rb") as r:
+                    shutil.copyfileobj(r, w)
+                entry["length"] = w.tell() - entry["offset"]
+                index.append(entry)
+            size = w.tell()
+
+        self._write_index(self.archive.get_index_path(), index, size)
+        os.replace(f"{raw}.tmp", raw)
+
+        for path in segments + sidecars:
+            os.unlink(path)
+
+    def _recompress(self, paths):
+        """
+        Decompress everything in ``paths`` and write it out to the raw path
+        in blocks of RAW_BLOCK_SIZE tweets.  ``paths`` may include the raw
+        archive itself.
+        """
+
+        raw = self.archive.get_raw_path()
+        destination = self.archive.get_raw_path(for_writing=True)
+        index = []
+
+        with open(f"{destination}.tmp", "wb") as w:
+            block = []
+            for path in paths:
+                with compression.open(path, "rb") as r:
+                    for line in r:
+                        block.append(line)
+                        if len(block) >= RAW_BLOCK_SIZE:
+                            index.append(self._write_block(w, block))
+                            block = []
+            if block:
+                index.append(self._write_block(w, block))
+            size = w.tell()
+
+        self._write_index(self.archive.get_index_path(), index, size)
+        self._replace(raw, destination)
+
+        for path in paths:
+            if path not in (raw, destination):
+                os.unlink(path)
+        for sidecar in glob.glob(os.path.join(self.cache_dir, "*.idx.json")):
+            os.unlink(sidecar)
+
+    @staticmethod
+    def _replace(raw, destination):
+        """
+        Swap the archive we've just written to ``destination``.tmp into
+        place.  If the codec's changed since the archive was last written,
+        the new one gets the new codec's name, and the old one goes.
+        """
+        os.replace(f"{destination}.tmp", destination)
+        if not raw == destination and os.path.exists(raw):
+            os.unlink(raw)
+
+    def _write_block(self, f, lines):
+        """
+        Compress ``lines`` as a stream of its own at the end of ``f`` and
+        return its entry for the index.
+        """
+
+        tweets = []
+        for line in lines:
+            try:
+                tweets.append(NormalisedTweet(json.loads(line)))
+            except (ValueError, KeyError, TypeError):
+                pass
+
+        entry = self._describe(tweets)
+        entry["tweets"] = len(lines)
+        entry["offset"] = f.tell()
+        f.write(compression.compress(b"".join(lines), "raw"))
+        entry["length"] = f.tell() - entry["offset"]
+
+        return entry
+
+    def _describe(self, tweets):
+        """
+        The time and id ranges covered by ``tweets`` in the form used by the
+        index.
+        """
+
+        r = {
+            "tweets": len(tweets),
+            "start": None,
+            "end": None,
+            "first_id": None,
+            "last_id": None,
+        }
+
+        for tweet in tweets:
+            if r["start"] is None or tweet.timestamp < r["start"]:
+                r["start"] = tweet.timestamp
+            if r["end"] is None or tweet.timestamp > r["end"]:
+                r["end"] = tweet.timestamp
+            if r["first_id"] is None or tweet.id < r["first_id"]:
+                r["first_id"] = tweet.id
+            if r["last_id"] is None or tweet.id > r["last_id"]:
+                r["last_id"] = tweet.id
+
+        return r
+
+    def _get_segments(self):
+        """
+        The segment file names are prefixed with the time of their first
+        tweet, so sorting them gives us (roughly) chronological order.
+        """
+        return sorted(glob.glob(os.path.join(self.cache_dir, "*.fjson*")))
+
+    @staticmethod
+    def _write_index(path, index, size):
+        """
+        We include the size of the archive the index describes so that readers
+        can tell if the two have fallen out of step, as they will briefly while
+        compact() swaps them out.
+        """
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(
+                {"size": size, "blocks": index}, f, separators=(",", ":"))
+        os.rename(f"{path}.tmp", path)
@@ -18,18 +18,13 @@ class SearchAggregator(Aggregator):
         for tweet in tweets:
             try:
                 Tweet.objects.create(
-                    id=tweet["id"],
+                    id=tweet.id,
                     archive=self.archive,
-                    created=datetime.datetime(
-                        *datetime.datetime.strptime(
-                            tweet["created_at"],
-                            "%a %b %d %H:%M:%S +0000 %Y"
-                        ).timetuple()[:6],
-                        tzinfo=pytz.UTC
-                    ),
-                    mentions=self._get_mentions_from_tweet(tweet),
-                    hashtags=self._get_hashtags_from_tweet(tweet),
-                    text=tweet["text"]
+                    created=datetime.datetime.fromtimestamp(
+                        tweet.timestamp, tz=pytz.UTC),
+                    mentions=list(set(tweet.mentions)),
+                    hashtags=self._get_hashtags_from_tweet(tweet.data),
+                    text=tweet.data["text"]
                 )
             except IntegrityError:
                 pass  # Sometimes we get >1 of the same tweet.  Weird.
@@ -45,11 +40,3 @@ class SearchAggregator(Aggregator):
             for hashtag in tweet["entities"]["hashtags"]:
                 r.append(hashtag["text"])
         return list(set(r))
-
-    @staticmethod
-    def _get_mentions_from_tweet(tweet):
-        r = []
-        if "entities" in tweet and "user_mentions" in tweet["entities"]:
-            for mention in tweet["entities"]["user_mentions"]:
-                r.append(mention["screen_name"])
-        return list(set(r))
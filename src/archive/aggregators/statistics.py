@@ -1,28 +1,29 @@
 import collections
 import copy
-import datetime
 import json
 import math
-import os
 import re
 
-import pycountry
-from django.conf import settings
+import numpy
 from django.utils import timezone
 
+from .. import resources
+from ..settings import HLL_HOURLY_PRECISION, HLL_PRECISION
+from ..sketches import HyperLogLog
 from .base import Aggregator
 
 
 class StatisticsAggregator(Aggregator):
 
+    TOP = 8  # The number of results we show for each statistic
+
+    # The (potentially huge) counters that we'll reduce to a sketch if
+    # SKETCH_ERROR is set.
+    SKETCHABLE = ("hashtags", "mentions", "retweetees")
+
     SENTIMENT_THRESHOLD = 0.6
     SENTIMENT_SPLIT_REGEX = re.compile(r"\W+")
 
-    TIME_FORMATS = {
-        "twitter": "%a %b %d %H:%M:%S %z %Y",
-        "iso": "%Y-%m-%dT%H:00:00%z",
-    }
-
     DEFAULT_AGGREGATE = {
         "makeup": {"Retweets": 0, "Original Content": 0, "Replies": 0},
         "languages": collections.defaultdict(int),
@@ -33,84 +34,171 @@ class StatisticsAggregator(Aggregator):
         "mentions": collections.defaultdict(int),
         "retweetees": collections.defaultdict(int),
         "total": 0,
-        "sentiments": {"Positive": 0, "Negative": 0, "Neutral": 0}
+        "sentiments": {"Positive": 0, "Negative": 0, "Neutral": 0},
+        "distinct": {"users": None, "tweets": None, "hours": {}},
     }
 
     def __init__(self, archive):
 
         super().__init__(archive)
 
-        self.read_cache()
-        self._set_afinn_db()
+        self._afinn = resources.get_sentiment_lexicon()
 
     def collect(self, tweets):
+        self.write_cache(self.collect_by_bucket(tweets))
+
+    def aggregate(self, tweets):
+        """
+        Pull the batch apart into columns in a single pass, then count each
+        of them in one go.  The string-keyed counters (hashtags, mentions &
+        retweetees) are still counted as we go, as there's nothing to be
+        gained by putting them in an array.
+        """
 
         aggregate = copy.deepcopy(self.DEFAULT_AGGREGATE)
 
-        for tweet in tweets:
+        hashless_query = self.archive.hashless_query
+
+        total = len(tweets)
+        hours = []
+        languages = []
+        countries = []
+        user_ids = numpy.empty(total, dtype=numpy.uint64)
+        tweet_ids = numpy.empty(total, dtype=numpy.uint64)
+        is_reply = numpy.zeros(total, dtype=bool)
+        is_retweet = numpy.zeros(total, dtype=bool)
+        sentiments = numpy.empty(total, dtype=numpy.float64)
+
+        for i, tweet in enumerate(tweets):
 
-            aggregate["languages"][self.get_language(tweet)] += 1
+            data = tweet.data
 
-            if "entities" in tweet:
+            hours.append(tweet.hour)
+            languages.append(tweet.language)
+            user_ids[i] = tweet.user_id
+            tweet_ids[i] = tweet.id
+            sentiments[i] = self._get_sentiment(tweet)
 
-                # URL Count
-                if "urls" in tweet["entities"]:
-                    aggregate["urls"] += len(tweet["entities"]["urls"])
+            # URL Count
+            aggregate["urls"] += len(tweet.entities.get("urls", ()))
 
-                # Hashtags
-                if "hashtags" in tweet["entities"]:
-                    for hashtag in tweet["entities"]["hashtags"]:
-                        hash_text = hashtag["text"].lower()
-                        if not hash_text == self.archive.hashless_query:
-                            aggregate["hashtags"][hash_text] += 1
+            # Hashtags
+            for hashtag in tweet.hashtags:
+                if not hashtag == hashless_query:
+                    aggregate["hashtags"][hashtag] += 1
 
-                # Mentions
-                if "user_mentions" in tweet["entities"]:
-                    for mention in tweet["entities"]["user_mentions"]:
-                        aggregate["mentions"][mention["screen_name"]] += 1
+            # Mentions
+            for mention in tweet.mentions:
+                aggregate["mentions"][mention] += 1
 
             # Countries
-            if "place" in tweet and tweet["place"]:
-                if "country_code" in tweet["place"]:
-                    country = tweet["place"]["country_code"].lower()
+            if "place" in data and data["place"]:
+                if "country_code" in data["place"]:
+                    country = data["place"]["country_code"].lower()
                     if country:
-                        aggregate["countries"]["complete"][country] += 1
-
-            # Times
-            created = datetime.datetime.strptime(
-                tweet["created_at"],
-                self.TIME_FORMATS["twitter"]
-            ).strftime(self.TIME_FORMATS["iso"])
-            aggregate["hours"][created] += 1
+                        countries.append(country)
 
             # Tweet types
-            if tweet["in_reply_to_user_id"]:
-                aggregate["makeup"]["Replies"] += 1
-            elif "retweeted_status" in tweet:
-                aggregate["makeup"]["Retweets"] += 1
-                user = tweet["retweeted_status"]["user"]["screen_name"]
+            if data["in_reply_to_user_id"]:
+                is_reply[i] = True
+            elif "retweeted_status" in data:
+                is_retweet[i] = True
+                user = data["retweeted_status"]["user"]["screen_name"]
                 aggregate["retweetees"][user] += 1
 
-            sentiment = self._get_sentiment(tweet)
-            if sentiment > self.SENTIMENT_THRESHOLD:
-                aggregate["sentiments"]["Positive"] += 1
-            elif sentiment < self.SENTIMENT_THRESHOLD * -1:
-                aggregate["sentiments"]["Negative"] += 1
-            else:
-                aggregate["sentiments"]["Neutral"] += 1
+        aggregate["total"] = total
+
+        hour_keys, hour_ids = self._count_column(aggregate["hours"], hours)
+        self._count_column(aggregate["languages"], languages)
+        self._count_column(aggregate["countries"]["complete"], countries)
+
+        replies = int(numpy.count_nonzero(is_reply))
+        retweets = int(numpy.count_nonzero(is_retweet))
+        aggregate["makeup"]["Replies"] = replies
+        aggregate["makeup"]["Retweets"] = retweets
+        aggregate["makeup"]["Original Content"] = total - retweets - replies
+
+        threshold = self.SENTIMENT_THRESHOLD
+        positive = int(numpy.count_nonzero(sentiments > threshold))
+        negative = int(numpy.count_nonzero(sentiments < threshold * -1))
+        aggregate["sentiments"]["Positive"] = positive
+        aggregate["sentiments"]["Negative"] = negative
+        aggregate["sentiments"]["Neutral"] = total - positive - negative
+
+        for group in self.SKETCHABLE:
+            aggregate[group] = self.sketch(aggregate[group], self.TOP * 4)
+
+        aggregate["distinct"] = self._get_distinct(
+            hour_keys, hour_ids, user_ids, tweet_ids)
+
+        return aggregate
+
+    @staticmethod
+    def _count_column(counter, column):
+        """
+        Add the number of occurrences of each value in ``column`` to
+        ``counter``, returning the distinct values along with the index of
+        each row's value among them.
+
+        numpy.unique() sorts the values, but ._simplify_statistic() depends
+        on the order they were first seen in (as they would be if we'd
+        counted them one at a time), so we put them back in that order.
+        """
+
+        if not column:
+            return [], numpy.empty(0, dtype=numpy.intp)
+
+        keys, first, ids = numpy.unique(
+            column, return_index=True, return_inverse=True)
+
+        order = numpy.argsort(first)
+        position = numpy.empty_like(order)
+        position[order] = numpy.arange(len(order))
+
+        keys = keys[order].tolist()
+        ids = position[ids]
+        for key, count in zip(keys, numpy.bincount(ids).tolist()):
+            counter[key] += count
+
+        return keys, ids
+
+    @staticmethod
+    def _get_distinct(hour_keys, hour_ids, user_ids, tweet_ids):
+        """
+        HyperLogLog sketches of the user & tweet ids, overall and per-hour.
+        """
 
-            aggregate["total"] += 1
+        r = {"hours": {}}
+        for kind, values in (("users", user_ids), ("tweets", tweet_ids)):
+            sketch = HyperLogLog(HLL_PRECISION)
+            sketch.add_many(values)
+            r[kind] = sketch.dump()
 
-        aggregate["makeup"]["Original Content"] = \
-            aggregate["total"] - \
-            aggregate["makeup"]["Retweets"] - \
-            aggregate["makeup"]["Replies"]
+        for i, hour in enumerate(hour_keys):
+            r["hours"][hour] = {}
+            in_hour = hour_ids == i
+            for kind, values in (("users", user_ids), ("tweets", tweet_ids)):
+                sketch = HyperLogLog(HLL_HOURLY_PRECISION)
+                sketch.add_many(values[in_hour])
+                r["hours"][hour][kind] = sketch.dump()
 
-        self.write_cache(aggregate)
+        return r
 
     def generate(self):
-        
-        aggregate = self.read_cache()
+
+        aggregate = self.distil(self.read_cache())
+
+        self.archive.statistics = json.dumps(aggregate, separators=(",", ":"))
+        self.archive.statistics_generated = timezone.now()
+        self.archive.total = aggregate["total"]
+
+        self.archive.save(update_fields=(
+            "statistics",
+            "statistics_generated",
+            "total"
+        ))
+
+    def distil(self, aggregate):
 
         aggregate["makeup"] = list(aggregate["makeup"].items())
 
@@ -124,45 +212,91 @@ class StatisticsAggregator(Aggregator):
             )
         )
 
-        for group in ("hashtags", "mentions", "retweetees"):
-            aggregate[group] = self._simplify_statistic(aggregate[group])
+        for group in self.SKETCHABLE:
+            aggregate[group] = self._simplify_statistic(
+                self.get_counts(aggregate[group]))
 
         aggregate["hours"] = self._hour_ranges(aggregate["hours"])
         aggregate["sentiments"] = list(aggregate["sentiments"].items())
+        aggregate["distinct"] = self._count_distinct(
+            aggregate["distinct"], aggregate["hours"]["times"])
 
-        self.archive.statistics = json.dumps(aggregate, separators=(",", ":"))
-        self.archive.statistics_generated = timezone.now()
-        self.archive.total = aggregate["total"]
-
-        self.archive.save(update_fields=(
-            "statistics",
-            "statistics_generated",
-            "total"
-        ))
+        return aggregate
 
     def update_aggregate(self, aggregate, addendum):
 
         self.update_aggregate_dict(aggregate["makeup"], addendum["makeup"])
         self.update_aggregate_dict(aggregate["languages"], addendum["languages"])  # NOQA: E501
         self.update_aggregate_dict(aggregate["countries"]["complete"], addendum["countries"]["complete"])  # NOQA: E501
-        self.update_aggregate_dict(aggregate["hashtags"], addendum["hashtags"])
-        self.update_aggregate_dict(aggregate["mentions"], addendum["mentions"])
-        self.update_aggregate_dict(aggregate["retweetees"], addendum["retweetees"])  # NOQA: E501
+        self.update_aggregate_counter(aggregate["hashtags"], addendum["hashtags"])  # NOQA: E501
+        self.update_aggregate_counter(aggregate["mentions"], addendum["mentions"])  # NOQA: E501
+        self.update_aggregate_counter(aggregate["retweetees"], addendum["retweetees"])  # NOQA: E501
         self.update_aggregate_dict(aggregate["hours"], addendum["hours"])
         self.update_aggregate_dict(aggregate["sentiments"], addendum["sentiments"])  # NOQA: E501
 
         aggregate["total"] += addendum["total"]
         aggregate["urls"] += addendum["urls"]
 
+        # Caches written before we started counting these won't have them
+        if "distinct" in addendum:
+            self._update_distinct(aggregate["distinct"], addendum["distinct"])
+
+    @classmethod
+    def _update_distinct(cls, primary, update):
+
+        cls._update_hyperloglog(primary, update, "users")
+        cls._update_hyperloglog(primary, update, "tweets")
+
+        for hour, counters in update["hours"].items():
+            if hour not in primary["hours"]:
+                primary["hours"][hour] = {"users": None, "tweets": None}
+            cls._update_hyperloglog(primary["hours"][hour], counters, "users")
+            cls._update_hyperloglog(primary["hours"][hour], counters, "tweets")
+
+    @staticmethod
+    def _update_hyperloglog(primary, update, key):
+
+        if update[key] is None:
+            return
+
+        if primary[key] is None:
+            primary[key] = update[key]
+            return
+
+        sketch = HyperLogLog.load(primary[key])
+        sketch.merge(HyperLogLog.load(update[key]))
+        primary[key] = sketch.dump()
+
+    @staticmethod
+    def _count_distinct(distinct, times):
+        """
+        Reduce the HyperLogLog sketches to estimates: overall, and per-hour
+        lined up with the times in the hours statistic.
+        """
+
+        r = {"hours": {"users": [], "tweets": []}}
+
+        for kind in ("users", "tweets"):
+            r[kind] = 0
+            if distinct[kind] is not None:
+                r[kind] = HyperLogLog.load(distinct[kind]).count()
+            for hour in times:
+                count = None
+                if hour in distinct["hours"]:
+                    count = HyperLogLog.load(
+                        distinct["hours"][hour][kind]).count()
+                r["hours"][kind].append(count)
+
+        return r
+
     @staticmethod
     def _translate_from_codes(stats, library):
 
         r = {}
         for code, total in stats.items():
-            try:
-                r[getattr(pycountry, library).lookup(code).name] = total
-            except LookupError:
-                pass
+            name = resources.get_name(library, code)
+            if name is not None:
+                r[name] = total
 
         if library == "languages" and "und" in stats:
             r["Undefined"] = stats["und"]
@@ -173,9 +307,12 @@ class StatisticsAggregator(Aggregator):
     def _simplify_statistic(stats):
         """
         Sort and limit the size of the result to a threshold number of results,
-        lumping everything else into an "other" category.
+        lumping everything else into an "other" category.  If we're given an
+        "other" category to start with (from a sketch), we add to it.
         """
 
+        other = stats.pop("*", 0)
+
         # Whittle down the stats to a maximum of a top 8
         top = []
         for k, v in stats.items():
@@ -183,7 +320,7 @@ class StatisticsAggregator(Aggregator):
                 top.append((k, v))
             top = sorted(top, key=lambda _: _[1], reverse=True)[:8]
 
-        stats["*"] = 0
+        stats["*"] = other
         threshold = sum([v for k, v in stats.items()]) / 12.5  # 1/8 of 100
         top_names = [_[0] for _ in top]
         delete = []
@@ -217,15 +354,8 @@ class StatisticsAggregator(Aggregator):
             r["data"].append(v)
         return r
 
-    def _set_afinn_db(self):
-        db = os.path.join(
-            settings.BASE_DIR, "archive", "db", "sentiment.json")
-        with open(db) as f:
-            self._afinn = json.load(f)
-
     def _get_sentiment(self, tweet):
-        text = self.get_complete_text(tweet)
-        text = self._split_camel_case(text.replace("#", ""))
+        text = self._split_camel_case(tweet.text.replace("#", ""))
         words = self.SENTIMENT_SPLIT_REGEX.split(text.lower())
         sentiments = [self._afinn.get(s, 0) for s in words]
         if not sentiments:
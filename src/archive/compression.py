@@ -0,0 +1,137 @@
+"""
+Every file we write is compressed, but not every file needs the same
+compression.  The final archives are kept forever and downloaded by people, so
+they're worth squeezing hard, while cache files and spooled batches are read
+back within a minute and then deleted, so all that matters there is speed.
+
+The codec for each class of file is set in COMPRESSION, and readers don't need
+to know any of this, as they work out the codec from the file's magic bytes.
+"""
+
+import builtins
+import gzip
+import io
+import lzma
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .settings import COMPRESSION
+
+CODEC_NONE = "none"
+CODEC_GZIP = "gzip"
+CODEC_ZSTD = "zstd"
+CODEC_XZ = "xz"
+
+EXTENSIONS = {
+    CODEC_NONE: "",
+    CODEC_GZIP: ".gz",
+    CODEC_ZSTD: ".zst",
+    CODEC_XZ: ".xz",
+}
+
+MAGIC = (
+    (b"\xfd7zXZ\x00", CODEC_XZ),
+    (b"\x1f\x8b", CODEC_GZIP),
+    (b"\x28\xb5\x2f\xfd", CODEC_ZSTD),
+)
+
+
+def get_codec(kind):
+    """
+    Return the (codec, level) pair for a class of file.  zstd is only used if
+    it's installed, otherwise we fall back to gzip.
+    """
+
+    codec, level = COMPRESSION[kind]
+
+    if codec == CODEC_ZSTD and zstandard is None:
+        return CODEC_GZIP, min(max(level, 1), 9)
+
+    return codec, level
+
+
+def get_extension(kind):
+    return EXTENSIONS[get_codec(kind)[0]]
+
+
+def detect(header):
+    for magic, codec in MAGIC:
+        if header.startswith(magic):
+            return codec
+    return CODEC_NONE
+
+
+def open(path, mode="rb", kind=None):
+    """
+    Open a file for binary reading or writing.  When writing, ``kind`` is
+    required so we know which codec to use.  When reading, we figure it out
+    for ourselves.
+    """
+
+    if "r" in mode:
+        with builtins.open(path, "rb") as f:
+            codec = detect(f.read(len(MAGIC[0][0])))
+        level = None
+    else:
+        codec, level = get_codec(kind)
+
+    if codec == CODEC_XZ:
+        return lzma.open(path, mode, preset=level)
+
+    if codec == CODEC_GZIP:
+        if level is None:
+            return gzip.open(path, mode)
+        return gzip.open(path, mode, compresslevel=level)
+
+    if codec == CODEC_ZSTD:
+        if "r" in mode:
+            # Stitched files can have more than one frame
+            return io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(
+                    builtins.open(path, "rb"),
+                    read_across_frames=True
+                )
+            )
+        return zstandard.ZstdCompressor(level=level).stream_writer(
+            builtins.open(path, mode))
+
+    return builtins.open(path, mode)
+
+
+def compress(data, kind):
+    """
+    Compress ``data`` into a single self-contained stream/frame/member, so
+    that the result can be concatenated with others of the same codec.
+    """
+
+    codec, level = get_codec(kind)
+
+    if codec == CODEC_XZ:
+        return lzma.compress(data, preset=level)
+
+    if codec == CODEC_GZIP:
+        return gzip.compress(data, compresslevel=level)
+
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    return data
+
+
+def decompress(data):
+
+    codec = detect(data)
+
+    if codec == CODEC_XZ:
+        return lzma.decompress(data)
+
+    if codec == CODEC_GZIP:
+        return gzip.decompress(data)
+
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    return data
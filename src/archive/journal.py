@@ -0,0 +1,193 @@
+"""
+A write-ahead log for the collector.  Every tweet the listener buffers for an
+archive is appended to that archive's journal first, so that if the
+collector dies, or a batch can't be handed to the broker, the tweets aren't
+lost with the buffer.
+
+The journal is a series of segments, one per batch.  When the listener takes
+a batch out of its buffer, the segment being written is sealed, and once the
+batch has been dispatched, the sealed segment is acknowledged (deleted).
+Anything still in the journal when the collector starts up again was never
+dispatched, so it's replayed (see the collector command).
+
+Just before a batch is handed to the broker, the ids of the segments opened
+for it are recorded alongside its journal segment, so that if we die before
+it's acknowledged, the replay reuses those segments rather than leaving them
+open with nothing to close them.
+
+Each line is flushed to the OS as it's written, so a crashed process loses
+nothing, but fsync() is only called every JOURNAL_SYNC_INTERVAL seconds
+(and whenever a segment is sealed), so that a busy stream isn't held up
+waiting on the disk.  A machine that goes down hard can lose up to that
+much.
+"""
+
+import json
+import os
+import time
+import uuid
+
+from django.conf import settings
+
+from .settings import JOURNAL_SYNC_INTERVAL
+
+JOURNAL_DIR = os.path.join(settings.MEDIA_ROOT, "journal")
+
+EXTENSION = ".fjson"
+SEGMENTS_EXTENSION = ".segments.json"
+
+
+class Journal:
+
+    def __init__(self, archive_id, directory=JOURNAL_DIR):
+        self.directory = os.path.join(directory, str(archive_id))
+        self.file = None
+        self.path = None
+        self.last_sync = time.monotonic()
+
+    def append(self, line):
+        """
+        :param line: A tweet as a JSON string
+        """
+
+        if self.file is None:
+            self._open()
+
+        self.file.write(bytes(line, "UTF-8") + b"\n")
+        self.file.flush()
+
+        if time.monotonic() - self.last_sync >= JOURNAL_SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
+
+    def seal(self):
+        """
+        Close the segment we've been writing to, and return its path so that
+        it can be acknowledged once its batch is dispatched.  If nothing's
+        been written since the last seal, there's no segment, and we return
+        None.
+        """
+
+        if self.file is None:
+            return None
+
+        self.sync()
+        self.file.close()
+
+        r = self.path
+        self.file = None
+        self.path = None
+
+        return r
+
+    def _open(self):
+        """
+        Segments are named for when they were started, so that replaying
+        them in name order replays them in the order they were written.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(
+            self.directory,
+            f"{int(time.time() * 1000000):017}-{uuid.uuid4().hex[:8]}{EXTENSION}"  # NOQA: E501
+        )
+        self.file = open(self.path, "ab")
+
+
+def acknowledge(path):
+    if path is None:
+        return
+    forget_segments(path)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def record_segments(path, segment_ids):
+    """
+    Note the ids of the ArchiveSegments opened for the batch in the journal
+    segment at ``path``.
+    """
+
+    if path is None:
+        return
+
+    tmp = f"{path}{SEGMENTS_EXTENSION}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(segment_ids, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, f"{path}{SEGMENTS_EXTENSION}")
+
+
+def get_segments(path):
+    """
+    Return the segment ids recorded for the journal segment at ``path``, or
+    None if there aren't any.
+    """
+    try:
+        with open(f"{path}{SEGMENTS_EXTENSION}") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def forget_segments(path):
+    if path is None:
+        return
+    try:
+        os.unlink(f"{path}{SEGMENTS_EXTENSION}")
+    except FileNotFoundError:
+        pass
+
+
+def get_unacknowledged(directory=JOURNAL_DIR):
+    """
+    Return a dictionary of archive id → the paths of its unacknowledged
+    segments, oldest first.
+    """
+
+    r = {}
+
+    if not os.path.exists(directory):
+        return r
+
+    for archive_dir in os.scandir(directory):
+        if not archive_dir.is_dir() or not archive_dir.name.isdigit():
+            continue
+        paths = sorted(
+            _.path for _ in os.scandir(archive_dir.path)
+            if _.name.endswith(EXTENSION)
+        )
+        if paths:
+            r[int(archive_dir.name)] = paths
+
+    return r
+
+
+def load(path):
+    """
+    Return the tweets in a segment as a list of JSON strings.  If we died
+    part-way through writing a line, that line is incomplete, so it's
+    dropped.
+    """
+
+    with open(path, "rb") as f:
+        lines = f.read().split(b"\n")
+
+    # Everything up to the last newline is complete
+    return [str(_, "UTF-8") for _ in lines[:-1] if _]
+
+
+def remove_empty(directory=JOURNAL_DIR):
+    if not os.path.exists(directory):
+        return
+    for archive_dir in os.scandir(directory):
+        try:
+            os.rmdir(archive_dir.path)
+        except OSError:
+            pass  # Not empty
@@ -0,0 +1,256 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import pycountry
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ... import journal, resources
+from ...aggregators.base import Aggregator
+from ...aggregators.cloud import CloudAggregator
+from ...aggregators.images import ImagesAggregator
+from ...aggregators.map import MapAggregator
+from ...aggregators.raw import RawAggregator
+from ...aggregators.statistics import StatisticsAggregator
+from ...models import Archive
+from ...synthetic import TweetGenerator
+from ...tweets import normalise
+from ..listeners import AlbatrossListener
+
+
+class Command(BaseCommand):
+    """
+    Offline benchmarks for the hot paths of the collector and the workers.
+    Nothing here needs a database, a broker, or Twitter.
+    """
+
+    help = "Run one of the benchmark suites"
+
+    # A typical spread of codes for one generate() of the statistics
+    LANGUAGES = (
+        "en", "es", "fr", "pt", "ja", "ar", "und", "de", "it", "tr", "ko",
+        "ru", "nl", "th", "pl", "sv", "hi", "el", "zh", "tl",
+    )
+    COUNTRIES = (
+        "us", "gb", "ca", "au", "in", "ie", "fr", "de", "es", "it", "nl",
+        "br", "mx", "ar", "jp", "ng", "za", "ke", "ph", "id", "gr", "tr",
+        "se", "no", "dk", "pl", "pt", "ch", "at", "be", "nz", "sg", "my",
+        "ae", "sa", "eg", "ru", "ua", "kr", "cn",
+    )
+
+    AGGREGATORS = (
+        RawAggregator,
+        StatisticsAggregator,
+        CloudAggregator,
+        ImagesAggregator,
+        MapAggregator,
+    )
+
+    # The queries of the archives in one stream for the listener benchmark
+    QUERIES = ("#benchmark", "#news", "#vote", "people", "#football")
+
+    def add_arguments(self, parser):
+        parser.add_argument("suite", choices=self._get_suites())
+        parser.add_argument("--iterations", type=int, default=100)
+        parser.add_argument(
+            "--sizes",
+            default="100,1000,10000,100000",
+            help="Comma-separated batch sizes"
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="The seed for the synthetic tweets"
+        )
+
+    def handle(self, *args, **options):
+        getattr(self, f"benchmark_{options['suite']}")(**options)
+
+    @classmethod
+    def _get_suites(cls):
+        return sorted(
+            _.replace("benchmark_", "", 1)
+            for _ in dir(cls) if _.startswith("benchmark_")
+        )
+
+    def benchmark_resources(self, iterations, **kwargs):
+        """
+        The per-task cost of the static data the statistics aggregator needs:
+        the sentiment lexicon for every collect() and the code → name lookups
+        for every generate().
+        """
+
+        def uncached():
+            with open(resources.SENTIMENT_DB) as f:
+                json.load(f)
+            for library, codes in self._get_codes():
+                for code in codes:
+                    try:
+                        getattr(pycountry, library).lookup(code)
+                    except LookupError:
+                        pass
+
+        def cached():
+            resources.get_sentiment_lexicon()
+            for library, codes in self._get_codes():
+                for code in codes:
+                    resources.get_name(library, code)
+
+        resources.clear()
+        start = time.perf_counter()
+        resources.warm()
+        boot = time.perf_counter() - start
+
+        self._report("Uncached (per task)", self._time(uncached, iterations))
+        self._report("Warm (worker boot)", boot)
+        self._report("Cached (per task)", self._time(cached, iterations))
+
+    def benchmark_aggregators(self, sizes, seed, **kwargs):
+        """
+        Throughput (tweets/s) and peak memory for each aggregator's collect(),
+        generate() and finalise(), for each batch size, over synthetic tweets.
+        Everything is written to a temporary directory and nothing is saved
+        to the database.  Memory is measured in a separate, traced, run so
+        that tracing doesn't skew the timings.
+        """
+
+        sizes = [int(_) for _ in sizes.split(",")]
+
+        self.stdout.write(
+            f"  {'':<12}{'size':>8}{'normalise':>12}{'collect':>12}"
+            f"{'generate':>12}{'finalise':>12}{'peak':>10}"
+        )
+        self.stdout.write(
+            f"  {'':<12}{'':>8}{'tweets/s':>12}{'tweets/s':>12}"
+            f"{'tweets/s':>12}{'tweets/s':>12}{'MB':>10}"
+        )
+
+        for size in sizes:
+
+            batch = TweetGenerator(seed=seed).tweets(size)
+
+            start = time.perf_counter()
+            tweets = normalise(batch)
+            normalising = time.perf_counter() - start
+
+            for aggregator_class in self.AGGREGATORS:
+
+                timings = self._run_aggregator(aggregator_class, tweets)
+
+                tracemalloc.start()
+                self._run_aggregator(aggregator_class, tweets)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                name = aggregator_class.get_type()
+                rates = "".join(
+                    f"{size / max(_, 1e-9):12.0f}"
+                    for _ in [normalising] + timings
+                )
+                self.stdout.write(
+                    f"  {name:<12}{size:>8}{rates}{peak / 2 ** 20:10.1f}")
+
+    def benchmark_listener(self, sizes, seed, **kwargs):
+        """
+        Tweets/s through the collector thread, from a line off the stream to
+        the tweet landing in a channel's buffer, with and without
+        LEAN_STREAM, and with and without the journal (written to a
+        temporary directory).  Batches aren't dispatched, as that's the
+        workers' problem.
+        """
+
+        runs = (
+            ("tweepy", False, False),
+            ("lean", True, False),
+            ("lean+journal", True, True),
+        )
+
+        for size in [int(_) for _ in sizes.split(",")]:
+
+            lines = TweetGenerator(seed=seed).lines(size)
+
+            for label, lean, journalled in runs:
+
+                directory = tempfile.mkdtemp(prefix="albatross-benchmark-")
+
+                listener = AlbatrossListener([
+                    Archive(pk=i, query=query, started=timezone.now())
+                    for i, query in enumerate(self.QUERIES, start=1)
+                ])
+                listener.dispatch = lambda *args, **kwargs: None
+                listener._get_backlog = lambda archive: 0
+                listener.lean = lean
+                for channel in listener.channels:
+                    channel["journal"] = None
+                    if journalled:
+                        channel["journal"] = journal.Journal(
+                            channel["archive"].pk, directory=directory)
+
+                try:
+                    start = time.perf_counter()
+                    for line in lines:
+                        listener.on_data(line)
+                    elapsed = time.perf_counter() - start
+                finally:
+                    shutil.rmtree(directory)
+
+                self.stdout.write(
+                    f"  {label:<14}{size:>8}{size / elapsed:12.0f} tweets/s")
+
+    def _run_aggregator(self, aggregator_class, tweets):
+        """
+        Collect, generate & finalise one batch for a throwaway archive,
+        returning the time each took.
+        """
+
+        directory = tempfile.mkdtemp(prefix="albatross-benchmark-")
+        cache_dir = Aggregator.CACHE_DIR
+
+        archive = Archive(
+            pk=1,
+            query="#benchmark",
+            started=timezone.now(),
+            allow_search=False
+        )
+        archive.ARCHIVES_DIR = os.path.join(directory, "archives")
+        archive.save = lambda *args, **kwargs: None
+        for subdirectory in ("raw", "map"):
+            os.makedirs(os.path.join(archive.ARCHIVES_DIR, subdirectory))
+
+        try:
+            Aggregator.CACHE_DIR = os.path.join(directory, "cache")
+            r = []
+            for method in ("collect", "generate", "finalise"):
+                aggregator = aggregator_class(archive)
+                args = (tweets,) if method == "collect" else ()
+                start = time.perf_counter()
+                getattr(aggregator, method)(*args)
+                r.append(time.perf_counter() - start)
+            return r
+        finally:
+            Aggregator.CACHE_DIR = cache_dir
+            shutil.rmtree(directory)
+
+    def _get_codes(self):
+        return (
+            ("languages", self.LANGUAGES),
+            ("countries", self.COUNTRIES),
+        )
+
+    @staticmethod
+    def _time(function, iterations):
+        """
+        The mean time of a call to ``function`` in seconds.
+        """
+        start = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        return (time.perf_counter() - start) / iterations
+
+    def _report(self, label, seconds):
+        self.stdout.write(f"  {label:<32} {seconds * 1000:10.3f}ms")
@@ -1,4 +1,5 @@
 import os
+import random
 import signal
 import sys
 import time
@@ -16,7 +17,8 @@ from django.db.utils import OperationalError, ProgrammingError
 from albatross.logging import LogMixin
 from users.models import User
 
-from ...models import Archive
+from ... import journal, spool
+from ...models import Archive, ArchiveSegment
 from ...tasks import backfill
 from ..listeners import AlbatrossListener
 from ..mixins import NotificationMixin
@@ -29,8 +31,15 @@ class Command(LogMixin, NotificationMixin, BaseCommand):
     """
 
     LOOP_TIME = 1
-    CHILL_TIME = 30  # 420: Enhance your calm
-    LISTENER_WAIT_TIME = 5  # Time to wait between starting listeners
+    GARBAGE_COLLECTION_TIME = 60 * 60  # Time between sweeps of the spool
+
+    # When a user's stream drops (or won't connect), we wait before trying
+    # again, doubling the wait every time it happens, up to the maximum.
+    # Once a stream's been up for RECONNECT_STABLE_TIME, the user's slate is
+    # wiped clean.
+    RECONNECT_BACKOFF = 30  # 420: Enhance your calm
+    RECONNECT_BACKOFF_MAX = 15 * 60
+    RECONNECT_STABLE_TIME = 5 * 60
 
     def __init__(self):
 
@@ -39,6 +48,11 @@ class Command(LogMixin, NotificationMixin, BaseCommand):
         self.streams = {}
         self.first_pass_completed = False
         self.verbosity = 1
+        self.last_garbage_collection = 0
+
+        # Users waiting to reconnect, keyed by user: {"attempts", "due",
+        # "archives", "connected"}
+        self.retries = {}
 
         self._wait_for_db()
 
@@ -57,6 +71,7 @@ class Command(LogMixin, NotificationMixin, BaseCommand):
         signal.signal(signal.SIGTERM, self.exit)
 
         try:
+            self._replay_journal()
             self.loop()
         except Exception as e:
             self.logger.error("Exception: {}".format(e))
@@ -88,6 +103,8 @@ class Command(LogMixin, NotificationMixin, BaseCommand):
             if to_start or to_stop:
                 self.adjust_connections(to_start, to_stop)
 
+            self._collect_garbage()
+
             sys.stdout.flush()
 
             time.sleep(self.LOOP_TIME)
@@ -135,7 +152,20 @@ class Command(LogMixin, NotificationMixin, BaseCommand):
                     groups[archive.user] = []
                 groups[archive.user].append(archive)
 
+        # Users with nothing left to track have nothing to retry either
+        for user in users_adjusting:
+            if user not in groups:
+                self.retries.pop(user, None)
+
         for user, archives in groups.items():
+
+            # A user who's backing off keeps waiting, even if their archives
+            # changed in the meantime.  They're connected with everything
+            # they're tracking by then once the wait is over.
+            if self._is_backing_off(user):
+                self.retries[user]["archives"] = [a.pk for a in archives]
+                continue
+
             self.logger.info("Connecting: {}::{}".format(user, archives))
             try:
                 api = self._authenticate(user)
@@ -149,8 +179,10 @@ class Command(LogMixin, NotificationMixin, BaseCommand):
                 )
             except Exception as e:
                 self._alert("Albatross collector exception [collector]", e)
-
-            time.sleep(self.LISTENER_WAIT_TIME)
+                self._schedule_retry(user, [a.pk for a in archives])
+            else:
+                if user in self.retries:
+                    self.retries[user]["connected"] = time.monotonic()
 
     def _get_archives_to_start(self, now):
         """
@@ -176,24 +208,162 @@ class Command(LogMixin, NotificationMixin, BaseCommand):
 
     def _handle_restarts(self, to_start):
         """
-        For when a stream spontaneously disconnects (errors, Twitter whim)
+        For when a stream spontaneously disconnects (errors, Twitter whim).
+        Rather than wait for it here, holding up everyone else, each user
+        that's dropped is given a time to retry at (see ._schedule_retry()),
+        and their archives are only restarted once it's come.
         """
 
-        to_restart = []
+        now = time.monotonic()
+
         for user, stream in self.streams.items():
-            if not stream.running:
+
+            retry = self.retries.get(user)
+
+            if stream.running:
+                if retry and retry["connected"]:
+                    if now - retry["connected"] > self.RECONNECT_STABLE_TIME:
+                        del self.retries[user]
+                continue
+
+            # Only a stream we've connected since the last time counts as
+            # having dropped again.
+            if retry is None or retry["connected"]:
                 self.logger.warning("Reconnection required: {}".format(user))
-                for channel in stream.listener.channels:
-                    to_restart.append(channel["archive"].pk)
+                self._schedule_retry(user, [
+                    _["archive"].pk for _ in stream.listener.channels])
+
+        to_restart = []
+        for user, retry in self.retries.items():
+            if not retry["connected"] and retry["due"] <= now:
+                to_restart += retry["archives"]
 
         if not to_restart:
             return to_start
 
-        time.sleep(self.CHILL_TIME)
-
         return Archive.objects.filter(
             pk__in=[a.pk for a in to_start] + to_restart)
 
+    def _schedule_retry(self, user, archive_ids):
+        """
+        Exponential backoff with jitter, so that users who dropped at the
+        same time (a Twitter hiccup) don't all come back at the same time
+        too.
+        """
+
+        attempts = 0
+        if user in self.retries:
+            attempts = self.retries[user]["attempts"]
+
+        delay = min(
+            self.RECONNECT_BACKOFF * 2 ** attempts,
+            self.RECONNECT_BACKOFF_MAX
+        ) * random.uniform(0.5, 1)
+
+        self.logger.info(f"Reconnecting {user} in {delay:.0f}s")
+
+        self.retries[user] = {
+            "attempts": attempts + 1,
+            "due": time.monotonic() + delay,
+            "archives": archive_ids,
+            "connected": None,
+        }
+
+    def _is_backing_off(self, user):
+        retry = self.retries.get(user)
+        if retry is None or retry["connected"]:
+            return False
+        return retry["due"] > time.monotonic()
+
+    def _replay_journal(self):
+        """
+        Dispatch anything left in the journal by the last run: batches that
+        never made it to the broker, and whatever was still buffered when
+        the collector died.  This has to happen before any streams are
+        started, as they'll start journalling again.
+
+        A batch that got as far as having its segments opened is dispatched
+        with those same segments, so none of them are left open.  That goes
+        for an empty one too (we died before any of it was written), as it's
+        the tasks that close them.
+
+        If an archive's been stopped in the meantime, its last batch is
+        flagged as final so it's rolled up.  If its final batch has already
+        been dispatched (by the last run, before it could acknowledge it),
+        anything else is dropped rather than written into a finished
+        archive.
+        """
+
+        now = datetime.now(tz=pytz.UTC)
+
+        for archive_id, paths in journal.get_unacknowledged().items():
+
+            archive = Archive.objects.filter(pk=archive_id).first()
+            if archive is None:
+                self.logger.warning(
+                    f"Dropping {len(paths)} journal segments for archive "
+                    f"#{archive_id}, as it no longer exists"
+                )
+                for path in paths:
+                    journal.acknowledge(path)
+                continue
+
+            is_stopped = bool(archive.stopped and archive.stopped <= now)
+
+            self.logger.info(
+                f"Replaying {len(paths)} journal segments for {archive}")
+
+            for i, path in enumerate(paths):
+
+                segment_ids = journal.get_segments(path)
+
+                if self._is_final_dispatched(archive, segment_ids):
+                    self.logger.warning(
+                        f"Dropping {path}, as the final batch of {archive} "
+                        f"has already been dispatched"
+                    )
+                    journal.acknowledge(path)
+                    continue
+
+                tweets = journal.load(path)
+                is_final = is_stopped and i == len(paths) - 1
+                if tweets or is_final or segment_ids:
+                    AlbatrossListener.dispatch(
+                        archive,
+                        tweets,
+                        is_final=is_final,
+                        segment_ids=segment_ids,
+                        journal_segment=path
+                    )
+                journal.acknowledge(path)
+
+        journal.remove_empty()
+
+    @staticmethod
+    def _is_final_dispatched(archive, segment_ids):
+        """
+        Whether a batch other than the one with ``segment_ids`` was the
+        archive's final batch.  Final segments outlive finalisation for this.
+        """
+        return ArchiveSegment.objects.filter(
+            archive=archive,
+            is_final=True
+        ).exclude(
+            pk__in=(segment_ids or {}).values()
+        ).exists()
+
+    def _collect_garbage(self):
+        """
+        Clear out any spooled batches that were never picked up by a worker.
+        """
+
+        if time.time() - self.last_garbage_collection < self.GARBAGE_COLLECTION_TIME:  # NOQA: E501
+            return
+
+        self.logger.info("Collecting spool garbage")
+        spool.collect_garbage()
+        self.last_garbage_collection = time.time()
+
     def _authenticate(self, user):
 
         socialtoken = SocialToken.objects.get(account__user=user)
@@ -0,0 +1,173 @@
+import functools
+import json
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from ...aggregators.cloud import CloudAggregator
+from ...aggregators.images import ImagesAggregator
+from ...aggregators.map import MapAggregator
+from ...aggregators.statistics import StatisticsAggregator
+from ...models import Archive, ArchiveSegment
+from ...tweets import normalise
+
+AGGREGATORS = {
+    ArchiveSegment.TYPE_CLOUD: CloudAggregator,
+    ArchiveSegment.TYPE_STATS: StatisticsAggregator,
+    ArchiveSegment.TYPE_IMAGES: ImagesAggregator,
+    ArchiveSegment.TYPE_MAP: MapAggregator,
+}
+
+
+def collect(archive, kinds, chunk):
+    """
+    Run in the pool.  ``chunk`` is either a list of JSON strings, or a block
+    from the raw archive's index that we read for ourselves.  Each aggregator
+    writes its partial aggregate to the cache as a delta, exactly as it would
+    for a batch off the stream, so merging them is left to .generate().
+    """
+
+    if isinstance(chunk, dict):
+        chunk = archive.get_block(chunk)
+
+    tweets = []
+    for line in chunk:
+        try:
+            tweets.append(json.loads(line))
+        except ValueError:
+            pass  # Same as everywhere else, we skip what we can't decode
+
+    tweets = normalise(tweets)
+    for kind in kinds:
+        AGGREGATORS[kind](archive).collect(tweets)
+
+    return len(chunk)
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the distillations of finished archives from their raw data, for
+    when the stop-words, sentiment data or the aggregators themselves change.
+    """
+
+    help = "Regenerate the distillations for one or more archives"
+
+    CHUNK_SIZE = 1000  # Tweets per chunk, where the archive has no index
+
+    def add_arguments(self, parser):
+        parser.add_argument("archives", nargs="*", type=int)
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Redistil every archive that isn't running"
+        )
+        parser.add_argument(
+            "--only",
+            default=",".join(AGGREGATORS),
+            help=f"A comma-separated subset of: {', '.join(AGGREGATORS)}"
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=os.cpu_count(),
+            help="The size of the process pool"
+        )
+        parser.add_argument("--chunk-size", type=int, default=self.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+
+        kinds = [_.strip() for _ in options["only"].split(",") if _.strip()]
+        for kind in kinds:
+            if kind not in AGGREGATORS:
+                raise CommandError(f"{kind} isn't something we can redistil")
+
+        archives = Archive.objects.filter(is_running=False).order_by("pk")
+        if not options["all"]:
+            if not options["archives"]:
+                raise CommandError("Specify some archives, or use --all")
+            archives = archives.filter(pk__in=options["archives"])
+            running = set(options["archives"]) - {_.pk for _ in archives}
+            if running:
+                raise CommandError(
+                    f"Some of those archives are running or don't exist: "
+                    f"{', '.join(str(_) for _ in sorted(running))}"
+                )
+
+        for archive in archives:
+            if not os.path.exists(archive.get_raw_path()):
+                self.stdout.write(f"Skipping #{archive.pk}: No raw data")
+                continue
+            self.redistil(
+                archive, kinds, options["processes"], options["chunk_size"])
+
+    def redistil(self, archive, kinds, processes, chunk_size):
+
+        self.stdout.write(f"Redistilling #{archive.pk}: {archive}")
+
+        # Start from a clean slate
+        for kind in kinds:
+            aggregator = AGGREGATORS[kind](archive)
+            aggregator.clear_cache()
+            aggregator.clear_buckets()
+
+        blocks = archive.get_block_index()
+        if blocks:
+            chunks = blocks
+            total = sum(_["tweets"] or 0 for _ in blocks) or None
+        else:
+            chunks = self._get_chunks(archive, chunk_size)
+            total = archive.total or None
+
+        # The children mustn't inherit our database connection
+        connections.close_all()
+
+        start = time.time()
+        done = 0
+
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.imap_unordered(
+                functools.partial(collect, archive, kinds), chunks)
+            for count in results:
+                done += count
+                self._report(done, total, start)
+
+        self.stdout.write("")
+
+        for kind in kinds:
+            self.stdout.write(f"  Generating {kind}")
+            aggregator = AGGREGATORS[kind](archive)
+            aggregator.generate()
+            aggregator.finalise()
+
+        archive.last_distilled = timezone.now()
+        archive.save(update_fields=("last_distilled",))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"  Done: {done} tweets in {time.time() - start:.1f}s"))
+
+    @staticmethod
+    def _get_chunks(archive, chunk_size):
+        chunk = []
+        for line in archive.get_tweets():
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _report(self, done, total, start):
+
+        rate = done / max(time.time() - start, 0.001)
+
+        progress = f"{done}"
+        if total:
+            progress = f"{done}/{total} ({min(done / total, 1):.0%})"
+
+        self.stdout.write(
+            f"\r  {progress} at {rate:.0f} tweets/s", ending="")
+        self.stdout.flush()
@@ -1,18 +1,44 @@
+import threading
 from sys import stderr
 from datetime import timedelta
+from django.db import connection
 from django.utils import timezone
 from tweepy import StreamListener
 
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from albatross import metrics
 from albatross.logging import LogMixin
 from users.models import User
 
+from .. import journal, spool
+from ..matching import QueryMatcher
 from ..models import Archive, ArchiveSegment
-from ..tasks import collect
+from ..settings import (
+    BATCH_BACKLOG_TARGET,
+    BATCH_RATE_SMOOTHING,
+    BATCH_SIZE_MAX,
+    BATCH_SIZE_MIN,
+    BATCH_WINDOW_MAX,
+    BATCH_WINDOW_MIN,
+    JOURNAL,
+    LEAN_STREAM,
+    PIPELINE,
+    RAW_PASSTHROUGH,
+    SEGMENT_TIMEOUT,
+    SPOOL
+)
+from ..tasks import collect, pipeline, reap
 from .mixins import NotificationMixin
 
 
 class AlbatrossListener(LogMixin, NotificationMixin, StreamListener):
 
+    # Where every channel starts out, before it's adapted to its rate and
+    # backlog (see ._adapt())
     BUFFER_SIZE = 999  # 1 less than the total tweets we want per batch
     AGGREGATION_WINDOW = timedelta(seconds=60)  # Max time between aggregations
 
@@ -31,65 +57,357 @@ class AlbatrossListener(LogMixin, NotificationMixin, StreamListener):
             self.channels.append({
                 "archive": archive,
                 "buffer": [],
-                "last-aggregation": timezone.now()
+                "last-aggregation": timezone.now(),
+                "buffer-size": self.BUFFER_SIZE,
+                "window": self.AGGREGATION_WINDOW,
+                "rate": None,  # Tweets/s
+                "journal": journal.Journal(archive.pk) if JOURNAL else None,
             })
 
+        # Every channel's query, compiled so that a tweet can be checked
+        # against all of them at once.
+        self.matcher = QueryMatcher([_.query for _ in archives])
+
+        self.lean = LEAN_STREAM
+
+        # The buffers are flushed from the stream's thread as they fill up,
+        # and from the flusher's when they've been sitting for longer than
+        # their window, so they're only touched with the lock held.
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.stopping = threading.Event()
+
+    def on_connect(self):
+        self.start_flusher()
+
     def on_data(self, raw_data):
+        """
+        With LEAN_STREAM, tweets never become tweepy models: we decode the
+        line once and route the dictionary.  Everything else, and everything
+        when LEAN_STREAM is off, goes through tweepy as usual.
+        """
+
         self.raw_data = raw_data
+
+        if self.lean:
+            data = json.loads(raw_data)
+            if "in_reply_to_status_id" in data:
+                return self.on_tweet(data)
+
         return StreamListener.on_data(self, raw_data)
 
+    def on_tweet(self, tweet):
+        """
+        The same as on_status(), but for a plain dictionary.
+        """
+
+        self.logger.debug(".")
+
+        texts = [tweet["text"]]
+        if "retweeted_status" in tweet:
+            texts.append(tweet["retweeted_status"]["text"])
+            if "quoted_status" in tweet["retweeted_status"]:
+                texts.append(tweet["retweeted_status"]["quoted_status"]["text"])  # NOQA: E501
+        elif "quoted_status" in tweet:
+            texts.append(tweet["quoted_status"]["text"])
+
+        self._route(tweet, texts)
+
     def on_status(self, status):
 
         self.logger.debug(".")
 
-        for channel in self.channels:
+        texts = [status.text]
+        if hasattr(status, "retweeted_status"):
+            texts.append(status.retweeted_status.text)
+            if hasattr(status.retweeted_status, "quoted_status"):
+                texts.append(status.retweeted_status.quoted_status["text"])
+        elif hasattr(status, "quoted_status"):
+            texts.append(status.quoted_status["text"])
+
+        # IMPORTANT: status._json isn't JSON at all, but a Python dictionary
+        # IMPORTANT: *generated* from the initial JSON.
+        self._route(status._json, texts)
+
+    def _route(self, tweet, texts):
+        matches = self.matcher.search(*texts)
+        for i, channel in enumerate(self.channels):
+            if i in matches:
+                self.on_vetted_tweet(channel, tweet)
+
+    def on_vetted_tweet(self, channel, tweet):
+        """
+        ``tweet`` is the tweet as a dictionary.  With RAW_PASSTHROUGH, we
+        buffer the line we got in on_data() instead.  It goes into the raw
+        archive verbatim and is parsed once on the worker side for everything
+        else.
+        """
 
-            query = channel["archive"].query.lower()
+        now = timezone.now()
+        if RAW_PASSTHROUGH:
+            tweet = self.raw_data.strip()
 
-            if query in status.text.lower():
+        line = None
+        if channel["journal"]:
+            line = tweet if RAW_PASSTHROUGH else json.dumps(tweet)
 
-                self.on_vetted_tweet(channel, status)
+        batch = None
+        with self.lock:
 
-            elif hasattr(status, "retweeted_status"):
+            if line:
+                channel["journal"].append(line)
+            channel["buffer"].append(tweet)
 
-                if query in status.retweeted_status.text.lower():
-                    self.on_vetted_tweet(channel, status)
-                elif hasattr(status.retweeted_status, "quoted_status"):
-                    if query in status.retweeted_status.quoted_status["text"].lower():  # NOQA: E501
-                        self.on_vetted_tweet(channel, status)
+            if now - channel["last-aggregation"] > channel["window"]:
+                batch = self._take(channel, now)
+            elif len(channel["buffer"]) > channel["buffer-size"]:
+                batch = self._take(channel, now)
 
-            elif hasattr(status, "quoted_status"):
+            depth = len(channel["buffer"])
 
-                if query in status.quoted_status["text"].lower():
-                    self.on_vetted_tweet(channel, status)
+        archive_id = channel["archive"].pk
+        metrics.TWEETS_INGESTED.inc(archive=archive_id)
+        metrics.BUFFER_DEPTH.set(depth, archive=archive_id)
 
-    def on_vetted_tweet(self, channel, status):
+        if batch:
+            self._send(channel["archive"], batch)
+            self._adapt(channel)
+
+    def start_flusher(self):
+        """
+        Start a thread to flush the buffers of quiet archives.  Without it, a
+        buffer is only ever looked at when a tweet arrives for it, so the last
+        few tweets of a lull could sit in memory, undistilled, indefinitely.
+        tweepy calls on_connect() on every reconnect, so this may be called
+        more than once.
         """
-        IMPORTANT: status._json isn't JSON at all, but a Python dictionary
-        IMPORTANT: *generated* from the initial JSON.
 
-        This might be further optimised by overriding on_data and skipping the
-        re-JSONing step.
+        if self.stopping.is_set():
+            return
+
+        if self.flusher and self.flusher.is_alive():
+            return
+
+        self.flusher = threading.Thread(
+            target=self._flush_periodically,
+            name=f"flusher-{self.user}",
+            daemon=True
+        )
+        self.flusher.start()
+
+    def stop_flusher(self):
+        """
+        Stop the flusher and wait for it to finish anything it's dispatching,
+        so that nothing can be dispatched after the final batch.
+        """
+        self.stopping.set()
+        if self.flusher and self.flusher is not threading.current_thread():
+            self.flusher.join()
+
+    def flush_stale(self):
+        """
+        Dispatch the buffer of every channel that hasn't been flushed within
+        its window.  An empty buffer has nothing to dispatch, but its window
+        starts again all the same, so the next tweet to arrive is never more
+        than one window away from being dispatched.
         """
 
         now = timezone.now()
-        channel["buffer"].append(status._json)
-
-        do_aggregation = False
-        if now - channel["last-aggregation"] > self.AGGREGATION_WINDOW:
-            do_aggregation = True
-        elif len(channel["buffer"]) > self.BUFFER_SIZE:
-            do_aggregation = True
-
-        if do_aggregation:
-            for class_name in [_[0] for _ in ArchiveSegment.TYPES]:
-                collect.delay(
-                    class_name,
-                    channel["archive"].pk,
-                    channel["buffer"]
+
+        batches = []
+        with self.lock:
+            for channel in self.channels:
+                if now - channel["last-aggregation"] >= channel["window"]:
+                    batches.append((channel, self._take(channel, now)))
+
+        for channel, batch in batches:
+            metrics.BUFFER_DEPTH.set(0, archive=channel["archive"].pk)
+            if batch[0]:
+                self._send(channel["archive"], batch)
+            self._adapt(channel)
+
+    def _flush_periodically(self):
+        try:
+            while not self.stopping.wait(self._get_time_to_flush()):
+                try:
+                    self.flush_stale()
+                except Exception as e:
+                    self._alert("Collector exception [flusher]", e)
+        finally:
+            connection.close()
+
+    def _get_time_to_flush(self):
+        """
+        Seconds until the first buffer's window is up.
+        """
+        with self.lock:
+            due = min(
+                _["last-aggregation"] + _["window"] for _ in self.channels)
+        return max((due - timezone.now()).total_seconds(), 0.1)
+
+    def _send(self, archive, batch, is_final=False):
+        """
+        Dispatch a batch from ._take(), and once it's safely with the broker,
+        acknowledge its journal segment.  If dispatching fails, the segment
+        is left for the collector to replay when it next starts.
+        """
+        tweets, segment = batch
+        self.dispatch(
+            archive, tweets, is_final=is_final, journal_segment=segment)
+        journal.acknowledge(segment)
+
+    @staticmethod
+    def _take(channel, now):
+        """
+        Empty a channel's buffer, returning what was in it along with the
+        journal segment it was written to, and fold the rate it filled at
+        into the channel's average.  This must only be called while holding
+        the lock.
+        """
+
+        tweets = channel["buffer"]
+
+        elapsed = max((now - channel["last-aggregation"]).total_seconds(), 0.001)  # NOQA: E501
+        rate = len(tweets) / elapsed
+        if channel["rate"] is not None:
+            rate = BATCH_RATE_SMOOTHING * rate + \
+                (1 - BATCH_RATE_SMOOTHING) * channel["rate"]
+        channel["rate"] = rate
+
+        channel["buffer"] = []
+        channel["last-aggregation"] = now
+
+        segment = None
+        if channel["journal"]:
+            segment = channel["journal"].seal()
+
+        return tweets, segment
+
+    def _adapt(self, channel):
+        """
+        Size the channel's next batch.  The window it covers grows with the
+        number of its batches the workers have yet to finish, so when
+        they're falling behind we send them fewer, bigger batches (which
+        cost them less per tweet), and when they're keeping up, smaller ones
+        so that the distillations stay fresh.  The size is then whatever
+        the channel's rate fills that window with.
+        """
+
+        pressure = max(self._get_backlog(channel["archive"]), 1) / BATCH_BACKLOG_TARGET  # NOQA: E501
+
+        window = min(max(
+            self.AGGREGATION_WINDOW.total_seconds() * pressure,
+            BATCH_WINDOW_MIN
+        ), BATCH_WINDOW_MAX)
+        size = min(max(
+            int(channel["rate"] * window),
+            BATCH_SIZE_MIN
+        ), BATCH_SIZE_MAX)
+
+        with self.lock:
+            channel["window"] = timedelta(seconds=window)
+            channel["buffer-size"] = size - 1
+
+        archive_id = channel["archive"].pk
+        metrics.BATCH_TARGET_SIZE.set(size, archive=archive_id)
+        metrics.BATCH_WINDOW.set(window, archive=archive_id)
+
+    @staticmethod
+    def _get_backlog(archive):
+        """
+        The batches dispatched for an archive that the workers have yet to
+        finish.  Every batch opens one segment of each type, so counting
+        one type will do.
+        """
+        return ArchiveSegment.objects.filter(
+            archive=archive,
+            type=ArchiveSegment.TYPE_RAW,
+            stop_time__isnull=True
+        ).count()
+
+    @staticmethod
+    @metrics.BATCH_FLUSH_DURATION.time()
+    def dispatch(archive, tweets, is_final=False, segment_ids=None,
+                 journal_segment=None):
+        """
+        Hand a batch of tweets off to the workers, either as a single pipeline
+        task, or as one collect task per aggregator.  Where spooling is
+        enabled, the tasks only get a reference to the batch on disk.
+
+        The segments for the batch are opened here rather than by the tasks,
+        so that by the time the final batch is dispatched, every batch before
+        it is already accounted for and finalisation can be left to whichever
+        task closes the last segment.
+
+        Their ids are recorded against the batch's ``journal_segment``, so
+        that when a batch is replayed from the journal, it's dispatched with
+        the ``segment_ids`` it had the first time around.  Any of those
+        segments that a task has already started on are skipped by the new
+        tasks (see tasks._open_segment()).
+
+        If the batch can't be handed to the broker, there'd be no task to
+        close the segments we opened, and they'd count towards the archive's
+        backlog forever, so they're deleted again, along with the spooled
+        batch, before the error is raised.  The batch itself is still in the
+        journal (where that's enabled) to be replayed.
+        """
+
+        metrics.BATCH_SIZE.observe(len(tweets))
+
+        if PIPELINE:
+            consumers = ("pipeline",)
+        else:
+            consumers = [_[0] for _ in ArchiveSegment.TYPES]
+
+        batches = {consumer: tweets for consumer in consumers}
+        opened = {}
+
+        try:
+
+            if SPOOL and tweets:
+                batches = spool.spill(archive.pk, tweets, consumers)
+
+            if segment_ids is None:
+                for class_name, _ in ArchiveSegment.TYPES:
+                    opened[class_name] = ArchiveSegment.objects.create(
+                        archive=archive, type=class_name, is_final=is_final).pk
+                segment_ids = opened
+                journal.record_segments(journal_segment, segment_ids)
+            elif is_final:
+                ArchiveSegment.objects.filter(
+                    pk__in=segment_ids.values()
+                ).update(
+                    is_final=True
+                )
+
+            if PIPELINE:
+                pipeline.delay(
+                    archive.pk,
+                    batches["pipeline"],
+                    is_final=is_final,
+                    segment_ids=segment_ids
                 )
-            channel["buffer"] = []
-            channel["last-aggregation"] = now
+            else:
+                for class_name in consumers:
+                    collect.delay(
+                        class_name,
+                        archive.pk,
+                        batches[class_name],
+                        is_final=is_final,
+                        segment_id=segment_ids[class_name]
+                    )
+
+            if is_final:
+                reap.apply_async((archive.pk,), countdown=SEGMENT_TIMEOUT)
+
+        except Exception:
+            if opened:
+                ArchiveSegment.objects.filter(pk__in=opened.values()).delete()
+                journal.forget_segments(journal_segment)
+            for reference in batches.values():
+                if isinstance(reference, str):
+                    spool.discard(reference)
+            raise
 
     def on_exception(self, exception):
 
@@ -136,20 +454,21 @@ class AlbatrossListener(LogMixin, NotificationMixin, StreamListener):
 
     def close_log(self):
 
+        self.stop_flusher()
+
         for channel in self.channels:
 
             # Refresh the archive instance in case things have changed
             archive = Archive.objects.get(pk=channel["archive"].pk)
 
-            for class_name in [_[0] for _ in ArchiveSegment.TYPES]:
+            with self.lock:
+                batch = self._take(channel, timezone.now())
 
-                collect.delay(
-                    class_name,
-                    archive.pk,
-                    channel["buffer"],
-                    is_final=archive.stopped <= timezone.now()
-                )
-                channel["buffer"] = []
+            self._send(
+                archive,
+                batch,
+                is_final=archive.stopped <= timezone.now()
+            )
 
         Archive.objects.filter(
             pk__in=[__["archive"].pk for __ in self.channels]
@@ -0,0 +1,99 @@
+"""
+Routing a tweet off the stream to the archives it belongs to means looking
+for every archive's query in the tweet's text.  Rather than searching the
+text once per query, we compile all of the queries into one pattern up front
+and find all of them in a single pass.
+"""
+
+import re
+
+
+class QueryMatcher:
+    """
+    Case-insensitive matching of a fixed set of queries.
+
+    The pattern is an alternation of every query inside a lookahead, so it's
+    tried at every position in the text without consuming anything, and
+    overlapping matches are all found.  At any one position, the alternation
+    only reports the longest query that matches there, but any shorter one
+    that matches at the same position is a prefix of it, so once we've seen
+    a query, we count every query it contains as found too.
+
+    This is the same one-pass search an Aho-Corasick automaton does, but the
+    scan happens inside the regex engine rather than in a Python loop over
+    every character, which makes it several times faster for the few
+    hundred queries the streaming API allows.  For only a handful of
+    queries though, a plain substring search for each is quicker still, so
+    that's what we do below DIRECT_LIMIT.
+    """
+
+    DIRECT_LIMIT = 16
+
+    def __init__(self, queries):
+        """
+        :param queries: An iterable of strings.  Duplicates are fine, and
+          .search() returns the positions of every query that matched.
+        """
+
+        self.queries = [_.lower() for _ in queries]
+
+        positions = {}
+        for i, query in enumerate(self.queries):
+            positions.setdefault(query, set()).add(i)
+
+        self.direct = None
+        if len(positions) <= self.DIRECT_LIMIT:
+            self.direct = list(positions.items())
+
+        # Every query that any given query contains, including itself
+        self.contains = {
+            query: frozenset(
+                i
+                for other, indexes in positions.items()
+                if other in query
+                for i in indexes
+            )
+            for query in positions
+        }
+
+        # The empty query is in everything
+        self.empty = self.contains.get("", frozenset())
+
+        # Longest first, so that the alternation prefers them
+        alternatives = [
+            re.escape(_)
+            for _ in sorted(positions, key=len, reverse=True) if _
+        ]
+        self.pattern = None
+        if alternatives:
+            self.pattern = re.compile(f"(?=({'|'.join(alternatives)}))")
+
+    def search(self, *texts):
+        """
+        Return the set of positions (in the list we were built with) of the
+        queries found in any of ``texts``.  Nones are skipped.
+        """
+
+        r = set(self.empty)
+
+        if self.pattern is None:
+            return r
+
+        texts = [_.lower() for _ in texts if _]
+
+        if self.direct is not None:
+            for query, indexes in self.direct:
+                for text in texts:
+                    if query in text:
+                        r.update(indexes)
+                        break
+            return r
+
+        found = set()
+        for text in texts:
+            found.update(self.pattern.findall(text))
+
+        for query in found:
+            r.update(self.contains[query])
+
+        return r
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.3 on 2026-10-17 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0003_archivesegment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivesegment',
+            name='is_final',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='archivesegment',
+            name='is_finalising',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 2.0.3 on 2026-10-17 11:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0004_archivesegment_is_final'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveSegmentSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('raw', 'Raw'), ('cloud', 'Cloud'), ('statistics', 'Statistics'), ('images', 'Images'), ('map', 'Map'), ('search', 'Search')], max_length=10)),
+                ('segments', models.PositiveIntegerField(default=0)),
+                ('tweets', models.PositiveIntegerField(default=0)),
+                ('collect_duration', models.FloatField(default=0)),
+                ('generate_duration', models.FloatField(default=0)),
+                ('max_collect_duration', models.FloatField(null=True)),
+                ('max_generate_duration', models.FloatField(null=True)),
+                ('bytes_written', models.BigIntegerField(default=0)),
+                ('files_written', models.PositiveIntegerField(default=0)),
+                ('start_time', models.DateTimeField(null=True)),
+                ('stop_time', models.DateTimeField(null=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('archive', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segment_summaries', to='archive.Archive')),
+            ],
+            options={
+                'ordering': ('archive', 'type', 'created'),
+            },
+        ),
+        migrations.AddField(
+            model_name='archivesegment',
+            name='bytes_written',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='archivesegment',
+            name='collect_duration',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='archivesegment',
+            name='files_written',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='archivesegment',
+            name='generate_duration',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='archivesegment',
+            name='tweets',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
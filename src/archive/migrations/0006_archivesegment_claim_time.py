@@ -0,0 +1,18 @@
+# Generated by Django 2.0.3 on 2026-10-17 14:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0005_archivesegment_instrumentation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivesegment',
+            name='claim_time',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -1,5 +1,5 @@
 import glob
-import lzma
+import json
 import os
 
 from django.conf import settings
@@ -9,6 +9,9 @@ from django.utils import timezone
 
 from albatross.logging import LogMixin
 
+from . import compression
+from .tweets import get_timestamp
+
 
 class Archive(LogMixin, models.Model):
 
@@ -81,39 +84,175 @@ class Archive(LogMixin, models.Model):
         return self.total / (stop_time - self.started).total_seconds()
 
     def calculate_size(self):
-        path = os.path.join(self.ARCHIVES_DIR, "raw", f"{self.pk:05}*fjson.xz")
-        return sum([os.stat(f).st_size for f in glob.glob(path)])
+        paths = set()
+        for extension in compression.EXTENSIONS.values():
+            paths.update(glob.glob(os.path.join(
+                self.ARCHIVES_DIR, "raw", f"{self.pk:09}*fjson{extension}")))
+        return sum([os.stat(f).st_size for f in paths])
+
+    def get_raw_path(self, for_writing=False):
+        """
+        Generate a conforming file name for this archive.  See ._find_name()
+        for why we only want the current codec's name ``for_writing``.
+        """
+        return os.path.join(
+            self.ARCHIVES_DIR, "raw", self._get_raw_name(for_writing))
+
+    def get_index_path(self):
+        """
+        The sidecar index of the blocks in the raw archive.  See
+        RawAggregator.finalise() for the details.
+        """
+        return os.path.join(
+            self.ARCHIVES_DIR, "raw", f"{self.pk:09}.fjson.idx.json")
 
-    def get_raw_path(self):
+    def get_buckets_dir(self):
         """
-        Generate a conforming file name for this archive.
+        Where the time-bucketed aggregates are kept.  Unlike the cache, these
+        outlive the collection.  See Aggregator.read_range().
         """
-        return os.path.join(self.ARCHIVES_DIR, "raw", f"{self.pk:09}.fjson.xz")
+        return os.path.join(self.ARCHIVES_DIR, "buckets", f"{self.pk:09}")
 
-    def get_tweets(self):
+    def get_tweets(self, since=None, until=None):
         """
         Collect all tweets from all compressed files and give us a generator
         yielding one tweet per iteration.
+
+        If ``since`` and/or ``until`` are specified, we limit the results to
+        tweets created in that window, and if the archive has a block index,
+        we only decompress the blocks that overlap with it.
+        """
+
+        if since is None and until is None:
+            yield from self._get_all_tweets()
+            return
+
+        start = since.timestamp() if since else float("-inf")
+        end = until.timestamp() if until else float("inf")
+
+        with open(self.get_raw_path(), "rb") as f:
+
+            blocks = self._get_blocks(os.fstat(f.fileno()).st_size)
+
+            if blocks is None:
+                for line in self._get_all_tweets():
+                    if self._is_in_window(line, start, end):
+                        yield line
+                return
+
+            for block in blocks:
+
+                # Blocks we couldn't index are always considered
+                if block["start"] is not None:
+                    if block["end"] < start or block["start"] >= end:
+                        continue
+
+                lines = self._read_block(f, block)
+
+                # Only check each tweet if the block straddles the window
+                contained = block["start"] is not None \
+                    and block["start"] >= start and block["end"] < end
+
+                for line in lines:
+                    if contained or self._is_in_window(line, start, end):
+                        yield line
+
+    def get_block_index(self):
+        """
+        The blocks of the raw archive, or None if it hasn't got a (valid)
+        index.
         """
         try:
-            with lzma.open(self.get_raw_path()) as f:
+            return self._get_blocks(os.stat(self.get_raw_path()).st_size)
+        except FileNotFoundError:
+            return None
+
+    def get_block(self, block):
+        """
+        Return the tweets in one of the blocks from .get_block_index().
+        """
+        with open(self.get_raw_path(), "rb") as f:
+            return self._read_block(f, block)
+
+    @staticmethod
+    def _read_block(f, block):
+        f.seek(block["offset"])
+        data = compression.decompress(f.read(block["length"]))
+        return [str(_, "UTF-8") for _ in data.splitlines() if _]
+
+    def _get_blocks(self, size):
+        """
+        Return the block index for the raw archive, or None if there isn't one
+        or it doesn't describe the file we have open.
+        """
+
+        try:
+            with open(self.get_index_path()) as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if not index.get("size") == size:
+            return None
+
+        return index["blocks"]
+
+    def _get_all_tweets(self):
+        try:
+            with compression.open(self.get_raw_path()) as f:
                 for line in f:
                     yield str(line.strip(), "UTF-8")
         except EOFError:
             pass
 
+    @staticmethod
+    def _is_in_window(line, start, end):
+        try:
+            created = get_timestamp(json.loads(line))
+        except (ValueError, KeyError):
+            return False
+        return start <= created < end
+
     def get_tweets_url(self):
         if not os.path.exists(self.get_raw_path()):
             return None
-        return os.path.join(self.ARCHIVES_URL, "raw", f"{self.pk:09}.fjson.xz")
+        return os.path.join(self.ARCHIVES_URL, "raw", self._get_raw_name())
 
-    def get_map_path(self):
+    def get_map_path(self, for_writing=False):
         return os.path.join(
-            self.ARCHIVES_DIR, "map", f"{self.pk:09}.json.xz")
+            self.ARCHIVES_DIR, "map", self._get_map_name(for_writing))
 
     def get_map_url(self):
-        return os.path.join(
-            self.ARCHIVES_URL, "map", f"{self.pk:09}.json.xz")
+        return os.path.join(self.ARCHIVES_URL, "map", self._get_map_name())
+
+    def _get_raw_name(self, for_writing=False):
+        return self._find_name("raw", f"{self.pk:09}.fjson", for_writing)
+
+    def _get_map_name(self, for_writing=False):
+        return self._find_name("map", f"{self.pk:09}.json", for_writing)
+
+    def _find_name(self, kind, stem, for_writing):
+        """
+        The file's extension is that of the codec that was configured when it
+        was written, which needn't be the one that's configured now.  Readers
+        work the codec out from the contents anyway, so if there's no file
+        under the current codec's name, we look for one under any other.
+        Writers always get the current codec's name.
+        """
+
+        name = f"{stem}{compression.get_extension(kind)}"
+        if for_writing:
+            return name
+
+        directory = os.path.join(self.ARCHIVES_DIR, kind)
+        if os.path.exists(os.path.join(directory, name)):
+            return name
+
+        for extension in compression.EXTENSIONS.values():
+            if os.path.exists(os.path.join(directory, f"{stem}{extension}")):
+                return f"{stem}{extension}"
+
+        return name
 
     def get_absolute_url(self):
         return "/archives/{}/statistics/".format(self.pk)
@@ -144,15 +283,93 @@ class ArchiveSegment(models.Model):
     archive = models.ForeignKey(
         Archive, related_name="segments", on_delete=models.CASCADE)
 
+    # Segments are opened when their batch is dispatched, and claimed when a
+    # worker picks the batch up.
     start_time = models.DateTimeField(default=timezone.now)
+    claim_time = models.DateTimeField(null=True)
     stop_time = models.DateTimeField(null=True)
 
+    # The last segment of a collection is flagged as final, and whoever
+    # closes the last outstanding segment of a type claims the finalisation
+    # of that type by flipping is_finalising.
+    is_final = models.BooleanField(default=False)
+    is_finalising = models.BooleanField(default=False)
+
+    # Instrumentation, filled in by the task that ran the segment.  Durations
+    # are in seconds, and the bytes & files are what the aggregator wrote to
+    # disk for this batch.
+    tweets = models.PositiveIntegerField(default=0)
+    collect_duration = models.FloatField(null=True)
+    generate_duration = models.FloatField(null=True)
+    bytes_written = models.BigIntegerField(default=0)
+    files_written = models.PositiveIntegerField(default=0)
+
     def __str__(self):
         if self.stop_time:
             return f"Completed {self.type} segment of {self.archive}"
         return f"Incomplete {self.type} segment of {self.archive}"
 
 
+class ArchiveSegmentSummary(models.Model):
+    """
+    Segments are deleted once their type is finalised, so we roll their
+    instrumentation up into one of these first to keep a record of how the
+    collection went.
+    """
+
+    archive = models.ForeignKey(
+        Archive, related_name="segment_summaries", on_delete=models.CASCADE)
+    type = models.CharField(max_length=10, choices=ArchiveSegment.TYPES)
+
+    segments = models.PositiveIntegerField(default=0)
+    tweets = models.PositiveIntegerField(default=0)
+    collect_duration = models.FloatField(default=0)
+    generate_duration = models.FloatField(default=0)
+    max_collect_duration = models.FloatField(null=True)
+    max_generate_duration = models.FloatField(null=True)
+    bytes_written = models.BigIntegerField(default=0)
+    files_written = models.PositiveIntegerField(default=0)
+
+    start_time = models.DateTimeField(null=True)
+    stop_time = models.DateTimeField(null=True)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ("archive", "type", "created")
+
+    def __str__(self):
+        return f"Summary of {self.segments} {self.type} segments of {self.archive}"  # NOQA: E501
+
+    @classmethod
+    def summarise(cls, archive, type):
+        """
+        Create a summary of the segments of ``type`` for ``archive``.
+        """
+
+        totals = ArchiveSegment.objects.filter(
+            archive=archive,
+            type=type
+        ).aggregate(
+            segments=models.Count("pk"),
+            tweets=models.Sum("tweets"),
+            collect_duration=models.Sum("collect_duration"),
+            generate_duration=models.Sum("generate_duration"),
+            max_collect_duration=models.Max("collect_duration"),
+            max_generate_duration=models.Max("generate_duration"),
+            bytes_written=models.Sum("bytes_written"),
+            files_written=models.Sum("files_written"),
+            start_time=models.Min("start_time"),
+            stop_time=models.Max("stop_time"),
+        )
+
+        # Sums over nothing come back as None
+        for field in ("tweets", "collect_duration", "generate_duration",
+                      "bytes_written", "files_written"):
+            totals[field] = totals[field] or 0
+
+        return cls.objects.create(archive=archive, type=type, **totals)
+
+
 class Event(models.Model):
     """
     Arbitrary event values for an archive that help explain behaviour.  These
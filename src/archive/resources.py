@@ -0,0 +1,73 @@
+"""
+Process-wide caches for the static data the aggregators lean on: the AFINN
+sentiment lexicon and the names for the language & country codes Twitter
+gives us.  Everything is loaded on first use and kept for the life of the
+process, but Celery workers call warm() at boot (see albatross.celery), so
+it's loaded once in the parent and shared with the forked pool processes
+via copy-on-write rather than reloaded by each of them.
+"""
+
+import functools
+import json
+import os
+
+import pycountry
+from django.conf import settings
+
+SENTIMENT_DB = os.path.join(
+    settings.BASE_DIR, "archive", "db", "sentiment.json")
+
+LIBRARIES = ("languages", "countries")
+
+
+@functools.lru_cache(maxsize=None)
+def get_sentiment_lexicon():
+    with open(SENTIMENT_DB) as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def get_names(library):
+    """
+    A code → name table for one of pycountry's databases, keyed on the
+    lower-cased alpha-2 and alpha-3 codes.
+    """
+
+    r = {}
+    for record in getattr(pycountry, library):
+        for attribute in ("alpha_2", "alpha_3"):
+            code = getattr(record, attribute, None)
+            if code:
+                r.setdefault(code.lower(), record.name)
+
+    return r
+
+
+@functools.lru_cache(maxsize=1024)
+def get_name(library, code):
+    """
+    The name for a code, or None if we don't know it.  Codes that aren't in
+    the table fall back to pycountry's (slow, fuzzy) lookup(), which is
+    memoised along with everything else.
+    """
+
+    r = get_names(library).get(code.lower())
+    if r is not None:
+        return r
+
+    try:
+        return getattr(pycountry, library).lookup(code).name
+    except LookupError:
+        return None
+
+
+def warm():
+    get_sentiment_lexicon()
+    for library in LIBRARIES:
+        get_names(library)
+
+
+def clear():
+    get_sentiment_lexicon.cache_clear()
+    get_names.cache_clear()
+    get_name.cache_clear()
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from .models import Archive, Event
+from .models import Archive, ArchiveSegment, ArchiveSegmentSummary, Event
 
 
 class DistillationField(serializers.HyperlinkedIdentityField):
@@ -32,6 +32,44 @@ class EventSerializer(serializers.ModelSerializer):
         fields = ("label", "time")
 
 
+class ArchiveSegmentSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ArchiveSegment
+        fields = (
+            "id",
+            "type",
+            "start_time",
+            "claim_time",
+            "stop_time",
+            "is_final",
+            "tweets",
+            "collect_duration",
+            "generate_duration",
+            "bytes_written",
+            "files_written",
+        )
+
+
+class ArchiveSegmentSummarySerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ArchiveSegmentSummary
+        fields = (
+            "type",
+            "segments",
+            "tweets",
+            "collect_duration",
+            "generate_duration",
+            "max_collect_duration",
+            "max_generate_duration",
+            "bytes_written",
+            "files_written",
+            "start_time",
+            "stop_time",
+        )
+
+
 class ArchiveSerializer(serializers.ModelSerializer):
 
     user_id = serializers.IntegerField()
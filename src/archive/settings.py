@@ -1 +1,91 @@
+import os
+
 LOOKBACK = 60  # Minutes
+
+# Send each batch to the workers once, to be run through every aggregator in a
+# single task, rather than once per aggregator.
+PIPELINE = True
+
+# Spill each batch to disk and only pass a reference to it through the broker.
+# Batches that are never claimed are removed after SPOOL_TTL.
+SPOOL = True
+SPOOL_TTL = 60 * 60 * 24  # Seconds
+
+# Write every tweet the collector buffers to a journal on disk first, so that
+# a batch that never made it to the broker can be replayed when the collector
+# restarts.  Journals are fsync()ed at most every JOURNAL_SYNC_INTERVAL.
+JOURNAL = True
+JOURNAL_SYNC_INTERVAL = 1  # Seconds
+
+# The number of tweets in each independently-compressed block of a finalised
+# raw archive.  Smaller blocks mean finer seeking, at the cost of compression.
+RAW_BLOCK_SIZE = 1000
+
+# How RawAggregator.finalise() builds the archive.  "stitch" concatenates the
+# cache segments as-is and leaves the recompression to a compact task on the
+# maintenance queue RAW_COMPACTION_DELAY seconds later.  "recompress" does it
+# all up front.
+RAW_FINALISE = "stitch"
+RAW_COMPACTION_DELAY = 60 * 60  # Seconds
+
+# Buffer the JSON exactly as it came off the stream, so the raw archive gets
+# Twitter's original bytes and we skip re-encoding each tweet along the way.
+RAW_PASSTHROUGH = True
+
+# The collector sizes each archive's batches to cover a window of time at the
+# rate tweets have been arriving for it (a moving average, with
+# BATCH_RATE_SMOOTHING as the weight of the latest batch).  The window is
+# stretched as batches for the archive back up with the workers, so they get
+# fewer, bigger batches to catch up with, and shrinks when they're idle, so
+# the distillations stay fresh.  BATCH_BACKLOG_TARGET is the number of
+# outstanding batches at which the window is the listener's
+# AGGREGATION_WINDOW.  Everything's kept within the bounds below, which can
+# be set per deployment from the environment.
+BATCH_SIZE_MIN = int(os.getenv("BATCH_SIZE_MIN", 100))
+BATCH_SIZE_MAX = int(os.getenv("BATCH_SIZE_MAX", 10000))
+BATCH_WINDOW_MIN = int(os.getenv("BATCH_WINDOW_MIN", 10))  # Seconds
+BATCH_WINDOW_MAX = int(os.getenv("BATCH_WINDOW_MAX", 300))  # Seconds
+BATCH_BACKLOG_TARGET = int(os.getenv("BATCH_BACKLOG_TARGET", 2))
+BATCH_RATE_SMOOTHING = 0.3
+
+# Decode tweets off the stream ourselves and route them on the plain
+# dictionary, rather than have tweepy build a Status (with its nested User,
+# retweeted Status and so on) for every one of them first.  Anything that
+# isn't a tweet (deletes, limits, disconnects) is still left to tweepy.
+LEAN_STREAM = True
+
+# The (codec, level) used for each class of file we write.  Codecs are "none",
+# "gzip", "zstd" (falls back to gzip if zstandard isn't installed) and "xz".
+# The raw segments are stitched together to make the final archive, so "raw"
+# applies to both.
+COMPRESSION = {
+    "raw": ("xz", 6),
+    "map": ("xz", 6),
+    "cache": ("zstd", 1),
+    "spool": ("zstd", 1),
+}
+
+# If set, the hashtag, mention, retweetee and word counters are kept as
+# SpaceSaving sketches of 1 / SKETCH_ERROR counters rather than exact (and
+# unbounded) counts.  Reported counts may then be overestimated by up to
+# SKETCH_ERROR * the total for that counter.
+SKETCH_ERROR = None
+
+# The precision of the HyperLogLog sketches used to count distinct users and
+# tweets, overall and per-hour.  A precision of p costs 2 ** p bytes per
+# sketch and gives a standard error of about 1.04 / sqrt(2 ** p).
+HLL_PRECISION = 12
+HLL_HOURLY_PRECISION = 10
+
+# How long a segment may sit unfinished before we assume its task died and
+# stop waiting on it when closing out an archive.  That's measured from when a
+# worker picked the batch up, as a long queue isn't a sign of anything dying.
+# A batch that's never picked up at all was presumably lost by the broker, but
+# we give it SEGMENT_QUEUE_TIMEOUT from dispatch to be sure.
+SEGMENT_TIMEOUT = 60 * 60  # Seconds
+SEGMENT_QUEUE_TIMEOUT = 24 * 60 * 60  # Seconds
+
+# The statistics, cloud and images aggregators also keep a partial aggregate
+# for every BUCKET_SIZE window of an archive, so that they can be distilled
+# for any time range without going back to the raw data.
+BUCKET_SIZE = 10 * 60  # Seconds
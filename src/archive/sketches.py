@@ -0,0 +1,210 @@
+"""
+Bounded-memory, mergeable summaries for the aggregates that would otherwise
+grow without limit on a busy archive.  Everything here serialises to plain
+JSON-friendly dictionaries so that it can live in the aggregate cache files
+alongside everything else, and can be merged from there in
+Aggregator.update_aggregate().
+"""
+
+import base64
+import heapq
+import math
+
+import numpy
+
+
+class SpaceSaving:
+    """
+    The Space-Saving heavy hitters summary (Metwally et al., 2005), merged as
+    per Agarwal et al.'s "Mergeable Summaries" (2012).  We only ever keep
+    ``capacity`` counters, and any count we report overestimates the true
+    value by no more than ``total / capacity``, so for an error bound of
+    ``e``, you want a capacity of ``1 / e``.
+
+    Serialised, it looks like this:
+
+      {"k": <capacity>, "n": <total>, "c": {<key>: [<count>, <error>], ...}}
+
+    A plain dictionary of exact counts can be loaded as well, so exact and
+    sketched aggregates can be merged with each other.
+    """
+
+    def __init__(self, capacity=None, counters=None, total=0):
+        self.capacity = capacity
+        self.counters = counters or {}
+        self.total = total
+
+    @classmethod
+    def get_capacity(cls, error, minimum=0):
+        return max(int(math.ceil(1 / error)), minimum)
+
+    @classmethod
+    def from_counts(cls, counts, capacity):
+        """
+        Build a sketch from a dictionary of exact counts, keeping only the
+        ``capacity`` largest.
+        """
+        top = heapq.nlargest(capacity, counts.items(), key=lambda _: _[1])
+        return cls(
+            capacity,
+            {k: [v, 0] for k, v in top},
+            sum(counts.values())
+        )
+
+    @staticmethod
+    def is_serialised(data):
+        return isinstance(data.get("c"), dict) and "k" in data
+
+    @classmethod
+    def load(cls, data):
+        if cls.is_serialised(data):
+            return cls(data["k"], data["c"], data["n"])
+        return cls(None, {k: [v, 0] for k, v in data.items()}, sum(data.values()))  # NOQA: E501
+
+    def dump(self):
+        return {"k": self.capacity, "n": self.total, "c": self.counters}
+
+    def merge(self, other):
+        """
+        Combine two sketches into a new one.  Any key missing from a full
+        sketch may have been evicted from it, so we have to assume it had as
+        many occurrences as that sketch's smallest counter.
+        """
+
+        capacities = [_ for _ in (self.capacity, other.capacity) if _]
+        capacity = max(capacities) if capacities else None
+
+        floor_a = self._get_floor()
+        floor_b = other._get_floor()
+
+        merged = {}
+        for key in set(self.counters).union(other.counters):
+            count_a, error_a = self.counters.get(key, (floor_a, floor_a))
+            count_b, error_b = other.counters.get(key, (floor_b, floor_b))
+            merged[key] = [count_a + count_b, error_a + error_b]
+
+        if capacity:
+            merged = dict(heapq.nlargest(
+                capacity, merged.items(), key=lambda _: _[1][0]))
+
+        return SpaceSaving(capacity, merged, self.total + other.total)
+
+    def counts(self):
+        return {k: v[0] for k, v in self.counters.items()}
+
+    def _get_floor(self):
+        if self.capacity and len(self.counters) >= self.capacity:
+            return min(_[0] for _ in self.counters.values())
+        return 0
+
+
+class HyperLogLog:
+    """
+    Flajolet et al.'s HyperLogLog (2007) cardinality estimator for counting
+    distinct integers (user & tweet ids) in a fixed amount of memory.  With
+    ``2 ** precision`` registers, the standard error is about
+    ``1.04 / sqrt(2 ** precision)``, so ~1.6% for the default of 12.
+    Merging is just the register-wise maximum.
+
+    Serialised, it looks like this:
+
+      {"p": <precision>, "r": <base64-encoded registers>}
+    """
+
+    MASK = (1 << 64) - 1
+
+    def __init__(self, precision, registers=None):
+        self.precision = precision
+        self.registers = numpy.zeros(1 << precision, dtype=numpy.uint8)
+        if registers is not None:
+            self.registers = registers
+
+    @classmethod
+    def load(cls, data):
+        return cls(data["p"], numpy.frombuffer(
+            base64.b64decode(data["r"]), dtype=numpy.uint8).copy())
+
+    def dump(self):
+        return {
+            "p": self.precision,
+            "r": str(base64.b64encode(self.registers.tobytes()), "ascii")
+        }
+
+    def add(self, value):
+
+        x = self._hash(value)
+
+        index = x >> (64 - self.precision)
+        remainder = x & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - remainder.bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add_many(self, values):
+        """
+        The same as calling .add() for each of ``values``, but done with
+        array operations.  Unsigned 64 bit arithmetic wraps in NumPy just as
+        the masking does in ._hash().
+        """
+
+        x = self._hash_many(numpy.asarray(values, dtype=numpy.uint64))
+
+        width = 64 - self.precision
+        index = (x >> numpy.uint64(width)).astype(numpy.intp)
+        remainder = x & numpy.uint64((1 << width) - 1)
+        rank = width - self._bit_length(remainder) + 1
+
+        numpy.maximum.at(self.registers, index, rank.astype(numpy.uint8))
+
+    def merge(self, other):
+        if not other.precision == self.precision:
+            raise ValueError("Only sketches of the same precision can merge")
+        numpy.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / numpy.sum(
+            numpy.power(2.0, -self.registers.astype(numpy.float64)))
+
+        # Small range correction: linear counting
+        zeros = int(numpy.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+
+        return int(round(estimate))
+
+    @classmethod
+    def _hash(cls, value):
+        """
+        The SplitMix64 finaliser.  Python's own hash() is both randomised per
+        process and the identity function for small ints, so it's no good
+        here.
+        """
+        x = (value + 0x9E3779B97F4A7C15) & cls.MASK
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & cls.MASK
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & cls.MASK
+        return x ^ (x >> 31)
+
+    @staticmethod
+    def _hash_many(x):
+        with numpy.errstate(over="ignore"):
+            x = x + numpy.uint64(0x9E3779B97F4A7C15)
+            x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)  # NOQA: E501
+            x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)  # NOQA: E501
+        return x ^ (x >> numpy.uint64(31))
+
+    @staticmethod
+    def _bit_length(x):
+        """
+        int.bit_length() for an array of uint64, by binary search.
+        """
+        r = numpy.zeros(x.shape, dtype=numpy.int64)
+        for shift in (32, 16, 8, 4, 2, 1):
+            shifted = x >> numpy.uint64(shift)
+            wider = shifted > 0
+            r[wider] += shift
+            x = numpy.where(wider, shifted, x)
+        return r + (x > 0)
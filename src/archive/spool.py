@@ -0,0 +1,115 @@
+"""
+A claim-check store for batches of tweets on their way from the collector to
+the workers.  Rather than stuffing up to 1000 tweets into every Celery
+message, the collector spills the batch to a (quickly) compressed file under
+MEDIA_ROOT and only sends a reference through the broker.
+
+Each consumer of a batch gets its own hard link to the same file, so it's
+written exactly once and the disk space is released as soon as the last
+consumer has discarded its reference.  Anything that's never claimed (a lost
+task, a dead worker) is swept up by collect_garbage().
+"""
+
+import json
+import os
+import shutil
+import time
+import uuid
+
+from django.conf import settings
+
+from . import compression
+from .settings import SPOOL_TTL
+
+SPOOL_DIR = os.path.join(settings.MEDIA_ROOT, "spool")
+
+
+def spill(archive_id, tweets, consumers):
+    """
+    Write a batch to the spool and return a dictionary of references, one per
+    consumer.  The tweets can be either dictionaries or the raw JSON strings
+    we got from Twitter.
+    """
+
+    directory = os.path.join(SPOOL_DIR, str(archive_id))
+    os.makedirs(directory, exist_ok=True)
+
+    key = uuid.uuid4()
+    extension = compression.get_extension("spool")
+    tmp = os.path.join(directory, f".{key}.fjson{extension}")
+
+    with compression.open(tmp, "wb", "spool") as f:
+        for tweet in tweets:
+            if not isinstance(tweet, str):
+                tweet = json.dumps(tweet, separators=(",", ":"))
+            f.write(bytes(tweet, "UTF-8") + b"\n")
+
+    r = {}
+    for consumer in consumers:
+        name = f"{key}.{consumer}.fjson{extension}"
+        os.link(tmp, os.path.join(directory, name))
+        r[consumer] = os.path.join(str(archive_id), name)
+
+    os.unlink(tmp)
+
+    return r
+
+
+def load(reference):
+    """
+    Return the batch as a list of JSON strings, one per tweet.
+    """
+    with compression.open(_get_path(reference), "rb") as f:
+        return [str(line.rstrip(b"\n"), "UTF-8") for line in f]
+
+
+def discard(reference):
+    try:
+        os.unlink(_get_path(reference))
+    except FileNotFoundError:
+        pass
+
+
+def collect_garbage(max_age=SPOOL_TTL):
+    """
+    Remove any spooled batches that have been sitting around for longer than
+    ``max_age`` seconds, along with any archive directories that are left
+    empty as a result.
+    """
+
+    if not os.path.exists(SPOOL_DIR):
+        return
+
+    threshold = time.time() - max_age
+
+    for archive_dir in os.scandir(SPOOL_DIR):
+
+        # Anything else in here (a stray file, say) isn't ours to touch
+        if not archive_dir.is_dir(follow_symlinks=False):
+            continue
+
+        try:
+            for entry in os.scandir(archive_dir.path):
+                try:
+                    if entry.stat().st_mtime < threshold:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+            if not os.listdir(archive_dir.path):
+                shutil.rmtree(archive_dir.path, ignore_errors=True)
+        except FileNotFoundError:
+            pass  # Removed while we were looking at it
+
+
+def _get_path(reference):
+    """
+    References arrive from the broker, so we make sure they can't point
+    anywhere outside of the spool.
+    """
+
+    path = os.path.realpath(os.path.join(SPOOL_DIR, reference))
+
+    if not path.startswith(os.path.realpath(SPOOL_DIR) + os.sep):
+        raise ValueError(f"Invalid spool reference: {reference}")
+
+    return path
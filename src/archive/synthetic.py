@@ -0,0 +1,205 @@
+"""
+A seeded generator of plausible-looking tweets for benchmarking without
+Twitter.  They're shaped like what the streaming API gives us (retweets,
+quotes, replies, media, places, coordinates and a spread of languages), in
+roughly realistic proportions, and the same seed always gives the same
+tweets.
+"""
+
+import json
+import random
+import time
+
+
+class TweetGenerator:
+
+    LANGUAGES = (
+        ("en", 50), ("es", 12), ("ja", 10), ("pt", 6), ("ar", 5), ("fr", 5),
+        ("und", 4), ("tr", 3), ("ko", 3), ("de", 2),
+    )
+    COUNTRIES = (
+        "us", "gb", "ca", "au", "in", "br", "jp", "mx", "fr", "de", "es", "ng",
+    )
+    WORDS = (
+        "the", "and", "people", "today", "just", "watching", "great", "bad",
+        "happy", "sad", "love", "hate", "news", "live", "vote", "game", "win",
+        "lose", "amazing", "terrible", "crowd", "speech", "rain", "city",
+        "morning", "night", "again", "never", "always", "best", "worst",
+        "thanks", "sorry", "wow", "yes", "no", "really", "think", "know",
+        "want", "need", "look", "watch", "read", "story", "thread", "photo",
+        "video", "breaking", "update", "friends", "family", "team", "fans",
+        "Hello", "WorldCup", "GoodMorning", "ThankYou", "música", "日本",
+    )
+    HASHTAGS = (
+        "news", "live", "vote", "tbt", "love", "music", "sport", "politics",
+        "breaking", "weather", "football", "art", "photo", "tech", "food",
+    )
+
+    RETWEET_RATE = 0.4
+    QUOTE_RATE = 0.1
+    REPLY_RATE = 0.15
+    MEDIA_RATE = 0.15
+    PLACE_RATE = 0.05
+    COORDINATES_RATE = 0.2  # Of those with a place
+
+    def __init__(self, seed=0, query="#benchmark", users=5000,
+                 start=1539202764, rate=50):
+        """
+        :param query: Mixed into the tweets, as it would be for an archive
+        :param users: The number of distinct users tweeting
+        :param start: The epoch time of the first tweet
+        :param rate: The average number of tweets per second
+        """
+
+        self.random = random.Random(seed)
+        self.query = query
+        self.users = users
+        self.rate = rate
+
+        self.now = float(start)
+        self.last_id = 1050000000000000000
+
+        self.languages = [_[0] for _ in self.LANGUAGES]
+        self.language_weights = [_[1] for _ in self.LANGUAGES]
+
+    def tweets(self, count):
+        return [self.tweet() for _ in range(count)]
+
+    def lines(self, count):
+        """
+        The same as .tweets(), but as JSON strings, the way they come off the
+        stream.
+        """
+        return [
+            json.dumps(_, ensure_ascii=False, separators=(",", ":"))
+            for _ in self.tweets(count)
+        ]
+
+    def tweet(self):
+
+        self.now += self.random.expovariate(self.rate)
+
+        r = self._get_status(self.now)
+
+        chance = self.random.random()
+        if chance < self.RETWEET_RATE:
+            original = self._get_status(
+                self.now - self.random.uniform(60, 86400))
+            r["retweeted_status"] = original
+            r["text"] = f"RT @{original['user']['screen_name']}: " \
+                f"{original['text']}"[:140]
+            r["entities"] = original["entities"]
+        elif chance < self.RETWEET_RATE + self.QUOTE_RATE:
+            r["quoted_status"] = self._get_status(
+                self.now - self.random.uniform(60, 86400))
+            r["is_quote_status"] = True
+        elif chance < self.RETWEET_RATE + self.QUOTE_RATE + self.REPLY_RATE:
+            user = self._get_user()
+            r["in_reply_to_user_id"] = user["id"]
+            r["in_reply_to_status_id"] = self._get_id()
+            r["text"] = f"@{user['screen_name']} {r['text']}"
+
+        return r
+
+    def _get_status(self, timestamp):
+
+        user = self._get_user()
+        language = self.random.choices(
+            self.languages, self.language_weights)[0]
+
+        hashtags = self.random.sample(
+            self.HASHTAGS, self.random.choice((0, 0, 1, 1, 2, 3)))
+        if self.random.random() < 0.3:
+            hashtags.append(self.query.lstrip("#"))
+        mentions = [
+            self._get_user() for _ in range(self.random.choice((0, 0, 1, 2)))]
+
+        words = self.random.choices(self.WORDS, k=self.random.randint(3, 20))
+        words += [f"#{_}" for _ in hashtags]
+        words += [f"@{_['screen_name']}" for _ in mentions]
+        self.random.shuffle(words)
+
+        entities = {
+            "hashtags": [{"text": _, "indices": [0, 0]} for _ in hashtags],
+            "user_mentions": [{
+                "screen_name": _["screen_name"],
+                "id": _["id"],
+                "id_str": _["id_str"],
+                "indices": [0, 0]
+            } for _ in mentions],
+            "urls": [],
+            "symbols": [],
+        }
+        if self.random.random() < 0.2:
+            entities["urls"].append({
+                "url": "https://t.co/abcdefghij",
+                "expanded_url": "https://example.com/story",
+                "indices": [0, 0]
+            })
+        if self.random.random() < self.MEDIA_RATE:
+            media_id = self._get_id()
+            entities["media"] = [{
+                "id": media_id,
+                "type": self.random.choice(("photo", "photo", "animated_gif")),
+                "media_url_https": f"https://pbs.twimg.com/media/{media_id}.jpg",  # NOQA: E501
+                "indices": [0, 0]
+            }]
+
+        tweet_id = self._get_id()
+        r = {
+            "created_at": time.strftime(
+                "%a %b %d %H:%M:%S +0000 %Y", time.gmtime(timestamp)),
+            "id": tweet_id,
+            "id_str": str(tweet_id),
+            "text": " ".join(words),
+            "source": "<a href=\"https://example.com\">Synthetic</a>",
+            "truncated": False,
+            "in_reply_to_status_id": None,
+            "in_reply_to_user_id": None,
+            "user": user,
+            "geo": None,
+            "coordinates": None,
+            "place": None,
+            "is_quote_status": False,
+            "entities": entities,
+            "lang": language,
+            "timestamp_ms": str(int(timestamp * 1000)),
+        }
+
+        if self.random.random() < self.PLACE_RATE:
+            lon = self.random.uniform(-180, 179)
+            lat = self.random.uniform(-80, 79)
+            r["place"] = {
+                "country_code": self.random.choice(self.COUNTRIES).upper(),
+                "bounding_box": {
+                    "type": "Polygon",
+                    "coordinates": [[
+                        [lon, lat], [lon, lat + 1],
+                        [lon + 1, lat + 1], [lon + 1, lat]
+                    ]]
+                }
+            }
+            if self.random.random() < self.COORDINATES_RATE:
+                r["coordinates"] = {
+                    "type": "Point",
+                    "coordinates": [lon + 0.5, lat + 0.5]
+                }
+
+        return r
+
+    def _get_user(self):
+        """
+        A few users tweet a lot, and most hardly at all.
+        """
+        n = int(self.random.paretovariate(1.2)) % self.users
+        return {
+            "id": 1000 + n,
+            "id_str": str(1000 + n),
+            "screen_name": f"user{n}",
+            "lang": self.random.choice(("en", "en", "es", None)),
+            "profile_image_url_https": f"https://pbs.twimg.com/{n}.jpg",
+        }
+
+    def _get_id(self):
+        self.last_id += self.random.randint(1, 1000000)
+        return self.last_id
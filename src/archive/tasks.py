@@ -1,6 +1,5 @@
 import datetime
 import json
-import lzma
 import os
 import time
 
@@ -8,21 +7,40 @@ import pytz
 import tweepy
 from allauth.socialaccount.models import SocialApp, SocialToken
 from celery.utils.log import get_task_logger
+from django.db.models import Q
 from django.utils import timezone
 
+from albatross import metrics
 from albatross.celery import app
 
+from . import compression, spool
 from .aggregators.cloud import CloudAggregator
 from .aggregators.images import ImagesAggregator
 from .aggregators.map import MapAggregator
 from .aggregators.raw import RawAggregator
 from .aggregators.search import SearchAggregator
 from .aggregators.statistics import StatisticsAggregator
-from .models import Archive, ArchiveSegment
-from .settings import LOOKBACK
+from .models import Archive, ArchiveSegment, ArchiveSegmentSummary
+from .settings import (
+    LOOKBACK,
+    RAW_COMPACTION_DELAY,
+    RAW_FINALISE,
+    SEGMENT_QUEUE_TIMEOUT,
+    SEGMENT_TIMEOUT
+)
+from .tweets import normalise
 
 logger = get_task_logger(__name__)
 
+AGGREGATORS = {
+    ArchiveSegment.TYPE_RAW: RawAggregator,
+    ArchiveSegment.TYPE_STATS: StatisticsAggregator,
+    ArchiveSegment.TYPE_CLOUD: CloudAggregator,
+    ArchiveSegment.TYPE_IMAGES: ImagesAggregator,
+    ArchiveSegment.TYPE_MAP: MapAggregator,
+    ArchiveSegment.TYPE_SEARCH: SearchAggregator,
+}
+
 
 @app.task
 def backfill(archive_id):
@@ -38,12 +56,15 @@ def backfill(archive_id):
     # Re-use the RawAggregator, so the backfilled tweets will automatically be
     # consolidated as part of RawAggregator.finalise().
     aggregator = RawAggregator(archive)
-    path = os.path.join(aggregator.cache_dir, "0.fjson.xz")
+    path = os.path.join(
+        aggregator.cache_dir, f"0.fjson{compression.get_extension('raw')}")
 
     # No sense in proceeding if this has already been done
     if os.path.exists(path):
         return
 
+    os.makedirs(aggregator.cache_dir, exist_ok=True)
+
     logger.info("Backfilling for %s", archive)
 
     socialtoken = SocialToken.objects.get(account__user=archive.user)
@@ -56,7 +77,7 @@ def backfill(archive_id):
     cursor = tweepy.Cursor(tweepy.API(auth).search, archive.query)
     collected_ids = []
 
-    with lzma.open(path, "wb") as f:
+    with compression.open(path, "wb", "raw") as f:
 
         try:
 
@@ -91,69 +112,306 @@ def backfill(archive_id):
 
 
 @app.task
-def collect(class_name, archive_id, tweets, is_final=False):
+def collect(class_name, archive_id, tweets, is_final=False, segment_id=None):
     """
     1. Pull in the cached copy of all stats from the cache.
     2. Update the stats dict from these tweets and re-cache it.
     3. Process the stats down into an aggregate and write that to the db.
+
+    ``tweets`` is either the batch itself, or a reference to where it was
+    spilled in the spool.  ``segment_id`` is the segment opened for this batch
+    at dispatch time.
+    """
+
+    archive = Archive.objects.get(pk=archive_id)
+
+    segment = _open_segment(archive, class_name, segment_id, is_final)
+    if segment is None:
+        _release(tweets)
+        return
+
+    try:
+        _run(AGGREGATORS[class_name](archive), segment, *_claim(tweets))
+    finally:
+        _release(tweets)
+        _close_segment(segment)
+
+
+@app.task
+def pipeline(archive_id, tweets, is_final=False, segment_ids=None):
     """
+    The same as collect(), but for every aggregator in one go.  The batch only
+    travels through the broker once and is only deserialised once, after which
+    the same list of tweets is handed to each aggregator in turn.
+
+    One aggregator failing mustn't cost the others their batch, so each one's
+    errors are logged and its segment closed before we move on to the next.
+    If the batch can't be read at all, there's nothing for any of them to do,
+    so they're all closed and the error is raised.
+    """
+
+    archive = Archive.objects.get(pk=archive_id)
+
+    segment_ids = segment_ids or {}
+    segments = {}
+    for class_name in AGGREGATORS:
+        segment = _open_segment(
+            archive, class_name, segment_ids.get(class_name), is_final)
+        if segment is not None:
+            segments[class_name] = segment
+
+    try:
+        if segments:
+            batch, lines = _claim(tweets)
+            for class_name in list(segments):
+                try:
+                    _run(AGGREGATORS[class_name](archive),
+                         segments[class_name], batch, lines)
+                except Exception:
+                    logger.exception(
+                        f"The {class_name} aggregator failed on a batch for "
+                        f"archive #{archive.pk}"
+                    )
+                finally:
+                    _close_segment(segments.pop(class_name))
+    finally:
+        for segment in segments.values():
+            _close_segment(segment)
+        _release(tweets)
+
 
-    classes = {
-        ArchiveSegment.TYPE_RAW: RawAggregator,
-        ArchiveSegment.TYPE_STATS: StatisticsAggregator,
-        ArchiveSegment.TYPE_CLOUD: CloudAggregator,
-        ArchiveSegment.TYPE_IMAGES: ImagesAggregator,
-        ArchiveSegment.TYPE_MAP: MapAggregator,
-        ArchiveSegment.TYPE_SEARCH: SearchAggregator,
-    }
+@app.task
+def finalise(archive_id, class_name):
+    """
+    Roll up everything an aggregator has collected for an archive.  This is
+    only ever queued by _maybe_finalise(), once every segment of this type is
+    closed, so there's nothing left to wait for.
+    """
 
     archive = Archive.objects.get(pk=archive_id)
 
-    segment = ArchiveSegment.objects.create(archive=archive, type=class_name)
+    logger.info(f"Rolling up {class_name} data for archive #{archive.pk}")
+
+    with metrics.AGGREGATOR_DURATION.time(type=class_name, phase="finalise"):
+        AGGREGATORS[class_name](archive).finalise()
+
+    # The final segment is kept as a record that the final batch has been
+    # dispatched (see the collector's ._replay_journal()), as are any segments
+    # reaped before they were claimed, so that their batches can still be
+    # collected if they turn up (see _open_segment()).
+    ArchiveSegmentSummary.summarise(archive, class_name)
+    ArchiveSegment.objects.filter(
+        archive=archive,
+        type=class_name,
+        is_final=False,
+        claim_time__isnull=False
+    ).delete()
+
+    if class_name == ArchiveSegment.TYPE_RAW and RAW_FINALISE == "stitch":
+        compact.apply_async((archive.pk,), countdown=RAW_COMPACTION_DELAY)
+
+
+@app.task
+def reap(archive_id):
+    """
+    Scheduled when the final batch of an archive is dispatched.  Any segment
+    that was claimed more than SEGMENT_TIMEOUT ago and is still open belongs
+    to a task that died, so we close it ourselves rather than wait on it
+    forever, and then give finalisation another go.  Segments that are still
+    queued only get the same treatment after SEGMENT_QUEUE_TIMEOUT, as a
+    backlog at the broker is no reason to give up on them.  If there's
+    anything still legitimately queued or running, we check back later.
+    """
+
+    now = timezone.now()
+
+    segments = ArchiveSegment.objects.filter(
+        archive_id=archive_id, stop_time__isnull=True)
+
+    stale = segments.filter(
+        Q(claim_time__lt=now - datetime.timedelta(seconds=SEGMENT_TIMEOUT)) |
+        Q(claim_time__isnull=True,
+          start_time__lt=now - datetime.timedelta(
+              seconds=SEGMENT_QUEUE_TIMEOUT))
+    )
+    for segment in stale:
+        logger.warning(f"Reaping stale segment #{segment.pk}: {segment}")
+    stale.update(stop_time=now)
+
+    for class_name in AGGREGATORS:
+        _maybe_finalise(archive_id, class_name)
+
+    if segments.exists():
+        reap.apply_async((archive_id,), countdown=SEGMENT_TIMEOUT)
+
+
+@app.task
+def compact(archive_id):
+    """
+    Recompress a stitched raw archive into larger blocks.  This is routed to
+    the maintenance queue (see CELERY_ROUTES), which should be served by a
+    low-priority worker.
+    """
+    RawAggregator(Archive.objects.get(pk=archive_id)).compact()
+
+
+def _claim(tweets):
+    """
+    Get the batch, either from the spool or the message itself, and return it
+    as a list of NormalisedTweets along with the original JSON strings, if
+    that's how they arrived.  This is the only place the batch is decoded &
+    normalised, so every aggregator in a pipeline shares the work.
+    """
+
+    if isinstance(tweets, str):
+        tweets = spool.load(tweets)
+
+    lines = None
+    if tweets and isinstance(tweets[0], str):
+        lines = tweets
+        tweets = [json.loads(_) for _ in tweets]
 
-    aggregator = classes[class_name](archive)
-    aggregator.collect(tweets)
+    return normalise(tweets), lines
+
+
+def _run(aggregator, segment, tweets, lines):
+    """
+    Collect & generate, noting how long each took and what was written on
+    the segment.  It's saved when the segment is closed.
+    """
+
+    start = time.perf_counter()
+    _collect(aggregator, tweets, lines)
+    segment.collect_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
     aggregator.generate()
+    segment.generate_duration = time.perf_counter() - start
 
-    segment.stop_time = timezone.now()
-    segment.save(update_fields=("stop_time",))
+    segment.tweets = len(tweets)
+    segment.bytes_written = aggregator.bytes_written
+    segment.files_written = aggregator.files_written
 
-    if is_final:
+    for phase in ("collect", "generate"):
+        metrics.AGGREGATOR_DURATION.observe(
+            getattr(segment, f"{phase}_duration"),
+            type=segment.type,
+            phase=phase
+        )
 
-        _wait_for_other_aggregators_to_close(archive, class_name)
 
-        logger.info(f"Rolling up {class_name} data for archive #{archive_id}")
+def _collect(aggregator, tweets, lines):
+    """
+    The raw aggregator can write the original JSON strings verbatim, so we
+    hand it those where we have them.  Everyone else gets the parsed tweets.
+    """
+    if isinstance(aggregator, RawAggregator):
+        aggregator.collect(tweets, lines=lines)
+    else:
+        aggregator.collect(tweets)
 
-        aggregator.finalise()
 
-        ArchiveSegment.objects.filter(
-            archive=archive, type=class_name).delete()
+def _release(tweets):
+    if isinstance(tweets, str):
+        spool.discard(tweets)
 
 
-def _wait_for_other_aggregators_to_close(archive, class_name):
+def _open_segment(archive, class_name, segment_id, is_final):
     """
-    By the time a final aggregator is called, we know that all of the other
-    aggregations have been called, but not necessarily finished.  We don't want
-    to issue a wrap-up until we know everything is done, so here we wait,
-    continuously checking the database to be sure all of the other bits are
-    done before we start our final run.
+    Claim the segment opened at dispatch time.  Messages queued before
+    segments were opened at dispatch time don't have one, so we open it here.
+
+    A batch replayed from the journal reuses its segments, so there can be
+    two tasks for the same segment.  Only the one that claims it gets to run;
+    the other drops the batch.
+
+    If the segment was reaped before anyone claimed it, the archive may
+    already have been rolled up without this batch, so we reopen the segment
+    as a final one and restore the aggregator's cache.  Closing it then rolls
+    the archive up again, this time with the batch included.
     """
 
-    time.sleep(5)  # Wait 5 seconds for other jobs to be picked up
+    now = timezone.now()
+
+    if segment_id is None:
+        return ArchiveSegment.objects.create(
+            archive=archive,
+            type=class_name,
+            is_final=is_final,
+            claim_time=now
+        )
+
+    unclaimed = ArchiveSegment.objects.filter(
+        pk=segment_id, claim_time__isnull=True)
+
+    claimed = unclaimed.filter(stop_time__isnull=True).update(claim_time=now)
+
+    if not claimed:
+        claimed = unclaimed.filter(stop_time__isnull=False).update(
+            claim_time=now,
+            stop_time=None,
+            is_final=True,
+            is_finalising=False
+        )
+        if claimed:
+            logger.warning(
+                f"Segment #{segment_id} ({class_name}) of archive "
+                f"#{archive.pk} was reaped before it could run.  Collecting "
+                f"it late."
+            )
+            AGGREGATORS[class_name](archive).restore_cache()
+
+    if not claimed:
+        logger.warning(
+            f"Segment #{segment_id} ({class_name}) of archive #{archive.pk} "
+            f"has already been claimed.  Dropping the batch."
+        )
+        return None
+
+    segment = ArchiveSegment.objects.get(pk=segment_id)
+
+    metrics.TASK_QUEUE_LAG.observe(
+        (now - segment.start_time).total_seconds(), type=class_name)
 
-    kwargs = {
-        "archive": archive,
-        "type": class_name,
-        "stop_time__isnull": True
-    }
+    return segment
 
-    while True:
 
-        ags = ArchiveSegment.objects.filter(**kwargs).count()
+def _close_segment(segment):
 
-        if not ags:
-            return
+    segment.stop_time = timezone.now()
+    segment.save(update_fields=(
+        "stop_time",
+        "tweets",
+        "collect_duration",
+        "generate_duration",
+        "bytes_written",
+        "files_written",
+    ))
+
+    _maybe_finalise(segment.archive_id, segment.type)
+
+
+def _maybe_finalise(archive_id, class_name):
+    """
+    The finalisation barrier.  Every closed segment checks whether it was the
+    last one outstanding for its type once the final batch has been
+    dispatched, and if so, queues the roll-up.  The check is repeated by
+    everyone, so the claim on is_finalising is a conditional update to make
+    sure only one of them actually queues it.
+    """
+
+    segments = ArchiveSegment.objects.filter(
+        archive_id=archive_id, type=class_name)
+
+    if segments.filter(stop_time__isnull=True).exists():
+        return
 
-        logger.info(f"Waiting for {ags} aggregations to complete.")
+    claimed = segments.filter(
+        is_final=True,
+        is_finalising=False
+    ).update(
+        is_finalising=True
+    )
 
-        time.sleep(5)
+    if claimed:
+        finalise.delay(archive_id, class_name)
@@ -1,3 +1,581 @@
-from django.test import TestCase
+import calendar
+import collections
+import copy
+import datetime
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+import numpy
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from . import journal, spool, tasks
+from .aggregators import raw
+from .aggregators.base import Aggregator
+from .aggregators.statistics import StatisticsAggregator
+from .management.commands.collector import Command as Collector
+from .management.listeners import AlbatrossListener
+from .matching import QueryMatcher
+from .models import Archive, ArchiveSegment
+from .settings import SEGMENT_QUEUE_TIMEOUT, SEGMENT_TIMEOUT
+from .sketches import HyperLogLog, SpaceSaving
+from .synthetic import TweetGenerator
+from .tweets import get_time, normalise
+
+
+class GetTimeTestCase(SimpleTestCase):
+
+    def test_matches_strptime(self):
+        """
+        The timestamp and hour key are what strptime used to give us,
+        whether they come from timestamp_ms or created_at, cached or not.
+        """
+
+        r = random.Random(0)
+        for _ in range(2000):
+
+            timestamp = r.randint(1136073600, 1893456000)  # 2006-2030
+            created_at = time.strftime(
+                "%a %b %d %H:%M:%S +0000 %Y", time.gmtime(timestamp))
+
+            parsed = datetime.datetime.strptime(
+                created_at, "%a %b %d %H:%M:%S %z %Y")
+            expected = (
+                calendar.timegm(parsed.utctimetuple()),
+                parsed.strftime("%Y-%m-%dT%H:00:00%z")
+            )
+
+            milliseconds = str(timestamp * 1000 + r.randint(0, 999))
+
+            self.assertEqual(expected[0], timestamp)
+            self.assertEqual(get_time({"created_at": created_at}), expected)
+            self.assertEqual(get_time({"created_at": created_at}), expected)
+            self.assertEqual(
+                get_time({"timestamp_ms": milliseconds}), expected)
+
+    def test_falls_back_to_strptime(self):
+        self.assertEqual(
+            get_time({"created_at": "Wed oct 10 20:19:24 +0000 2018"}),
+            (1539202764, "2018-10-10T20:00:00+0000")
+        )
+
+
+class QueryMatcherTestCase(SimpleTestCase):
+    """
+    Whichever path it takes, the matcher has to find exactly what a
+    case-insensitive substring search for each query would.  The alphabet
+    is tiny so that the queries overlap, contain each other and repeat.
+    """
+
+    ALPHABET = "aAbB#éÉ "
+
+    def test_few_queries(self):
+        for seed in range(200):
+            self._compare(random.Random(seed), QueryMatcher.DIRECT_LIMIT)
+
+    def test_many_queries(self):
+        for seed in range(200):
+            self._compare(random.Random(seed), 100)
+
+    def test_pattern_with_few_queries(self):
+        for seed in range(200):
+            self._compare(
+                random.Random(seed), QueryMatcher.DIRECT_LIMIT, direct=False)
+
+    def _compare(self, r, count, direct=True):
+
+        queries = [self._get_string(r, 0, 4) for _ in range(count)]
+        matcher = QueryMatcher(queries)
+        if not direct:
+            matcher.direct = None
+
+        for _ in range(20):
+
+            texts = [
+                self._get_string(r, 0, 30) for _ in range(r.randint(1, 3))]
+
+            expected = {
+                i for i, query in enumerate(queries)
+                if any(query.lower() in _.lower() for _ in texts)
+            }
+
+            texts.append(None)  # Which should be skipped
+
+            self.assertEqual(matcher.search(*texts), expected)
+
+    def _get_string(self, r, shortest, longest):
+        return "".join(
+            r.choice(self.ALPHABET)
+            for _ in range(r.randint(shortest, longest))
+        )
+
+
+class SpaceSavingTestCase(SimpleTestCase):
+
+    CAPACITY = 10
+
+    def test_merged_counts_are_within_the_error_bound(self):
+        """
+        Every count a sketch reports overestimates the true count by no more
+        than total / capacity, and by no more than the error it reports.
+        """
+        for seed in range(50):
+            batches = self._get_batches(seed)
+            true = sum(batches, collections.Counter())
+            sketch = self._merge(
+                [SpaceSaving.from_counts(_, self.CAPACITY) for _ in batches])
+            self.assertEqual(sketch.total, sum(true.values()))
+            self.assertLessEqual(len(sketch.counters), self.CAPACITY)
+            self._assert_within_bound(sketch, true)
+
+    def test_merge_is_associative(self):
+        """
+        Nothing's evicted below capacity, so merging in any order gives the
+        same sketch.  Once counters are being evicted, what survives depends
+        on the order, but every order stays within the same error bound.
+        """
+
+        for seed in range(50):
+
+            batches = self._get_batches(seed)
+            true = sum(batches, collections.Counter())
+
+            exact = [SpaceSaving.from_counts(_, len(true)) for _ in batches]
+            a, b, c = exact
+            self.assertEqual(
+                a.merge(b).merge(c).dump(), a.merge(b.merge(c)).dump())
+
+            a, b, c = [
+                SpaceSaving.from_counts(_, self.CAPACITY) for _ in batches]
+            left = a.merge(b).merge(c)
+            right = a.merge(b.merge(c))
+            self.assertEqual(left.total, right.total)
+            for sketch in (left, right):
+                self._assert_within_bound(sketch, true)
+            for key in set(left.counters).intersection(right.counters):
+                self.assertLessEqual(
+                    abs(left.counters[key][0] - right.counters[key][0]),
+                    left.total / self.CAPACITY
+                )
+
+    def test_exact_counts_load_and_merge(self):
+
+        a = SpaceSaving.load({"x": 3, "y": 1})
+        b = SpaceSaving.load(
+            SpaceSaving.from_counts({"x": 2, "z": 5}, 4).dump())
+
+        merged = a.merge(b)
+
+        self.assertEqual(merged.counts(), {"x": 5, "y": 1, "z": 5})
+        self.assertEqual(merged.total, 11)
+        self.assertEqual(merged.capacity, 4)
+
+    def test_empty(self):
+        sketch = SpaceSaving.from_counts({}, self.CAPACITY)
+        self.assertEqual(sketch.counts(), {})
+        self.assertEqual(sketch.merge(SpaceSaving.load({})).total, 0)
+
+    def _assert_within_bound(self, sketch, true):
+        for key, (count, error) in sketch.counters.items():
+            self.assertLessEqual(true[key], count)
+            self.assertLessEqual(count - error, true[key])
+            self.assertLessEqual(
+                count - true[key], sketch.total / self.CAPACITY)
+
+    @staticmethod
+    def _get_batches(seed):
+        """
+        Three batches of keys with a long tail, as hashtags have.
+        """
+        r = random.Random(seed)
+        return [
+            collections.Counter(
+                f"#{int(r.paretovariate(1.1))}"
+                for _ in range(r.randint(50, 500))
+            )
+            for _ in range(3)
+        ]
+
+    @staticmethod
+    def _merge(sketches):
+        r = sketches[0]
+        for sketch in sketches[1:]:
+            r = r.merge(sketch)
+        return r
+
+
+class HyperLogLogTestCase(SimpleTestCase):
+
+    PRECISION = 12
+
+    def setUp(self):
+        r = random.Random(0)
+        self.ids = [r.getrandbits(64) for _ in range(20000)]
+
+    def test_add_many_is_the_same_as_add(self):
+
+        one_at_a_time = HyperLogLog(self.PRECISION)
+        for value in self.ids:
+            one_at_a_time.add(value)
+
+        all_at_once = HyperLogLog(self.PRECISION)
+        all_at_once.add_many(numpy.array(self.ids, dtype=numpy.uint64))
+
+        self.assertEqual(all_at_once.dump(), one_at_a_time.dump())
+        self.assertEqual(
+            HyperLogLog._hash_many(numpy.array(self.ids, dtype=numpy.uint64))
+            .tolist(),
+            [HyperLogLog._hash(_) for _ in self.ids]
+        )
+
+    def test_cardinality(self):
+        """
+        Within three standard errors of the true count, with duplicates
+        ignored.
+        """
+
+        sketch = HyperLogLog(self.PRECISION)
+        sketch.add_many(self.ids + self.ids[:5000])
+
+        error = 1.04 / (2 ** self.PRECISION) ** 0.5
+        self.assertLess(
+            abs(sketch.count() - len(self.ids)), 3 * error * len(self.ids))
+
+        small = HyperLogLog(self.PRECISION)
+        small.add_many(self.ids[:100])
+        self.assertLess(abs(small.count() - 100), 3)
+
+    def test_merge(self):
+        """
+        Merging is the register-wise maximum, so it's associative, and the
+        same as having seen everything in one sketch.
+        """
+
+        a, b, c = [HyperLogLog(self.PRECISION) for _ in range(3)]
+        for sketch, values in zip((a, b, c), numpy.array_split(
+                numpy.array(self.ids, dtype=numpy.uint64), 3)):
+            sketch.add_many(values)
+
+        everything = HyperLogLog(self.PRECISION)
+        everything.add_many(self.ids)
+
+        left = HyperLogLog.load(a.dump())
+        left.merge(b)
+        left.merge(c)
+
+        right = HyperLogLog.load(b.dump())
+        right.merge(c)
+        right.merge(a)
+
+        self.assertEqual(left.dump(), right.dump())
+        self.assertEqual(left.dump(), everything.dump())
+
+        with self.assertRaises(ValueError):
+            a.merge(HyperLogLog(self.PRECISION - 1))
+
+    def test_empty(self):
+        sketch = HyperLogLog(self.PRECISION)
+        sketch.add_many([])
+        self.assertEqual(sketch.count(), 0)
+        self.assertEqual(HyperLogLog.load(sketch.dump()).count(), 0)
+
+
+class SpoolTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        patcher = mock.patch.object(spool, "SPOOL_DIR", self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_collect_garbage_skips_stray_files(self):
+
+        references = spool.spill(1, ['{"id":1}'], ("pipeline",))
+        path = os.path.join(self.directory, references["pipeline"])
+        os.utime(path, (0, 0))
+
+        stray = os.path.join(self.directory, ".DS_Store")
+        open(stray, "w").close()
+
+        spool.collect_garbage()
+
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "1")))
+        self.assertTrue(os.path.exists(stray))
+
+
+class RawAggregatorTestCase(SimpleTestCase):
+
+    def setUp(self):
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        patcher = mock.patch.object(
+            Aggregator, "CACHE_DIR", os.path.join(directory, "cache"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.directory = directory
+
+        self.batches = [
+            normalise(TweetGenerator(seed=seed).tweets(50))
+            for seed in range(3)
+        ]
+
+    def test_finalising_again_keeps_the_archive(self):
+        for method in ("stitch", "recompress"):
+            with self.subTest(method=method):
+                with mock.patch.object(raw, "RAW_FINALISE", method):
+                    self._test_finalising_again(method)
+
+    def _test_finalising_again(self, method):
+
+        self.archive = Archive(
+            pk=1, query="#benchmark", started=timezone.now())
+        self.archive.ARCHIVES_DIR = os.path.join(self.directory, method)
+        self.archive.save = lambda *args, **kwargs: None
+        os.makedirs(os.path.join(self.archive.ARCHIVES_DIR, "raw"))
+
+        self._finalise(self.batches[:2])
+        expected = self._get_ids(self.batches[0] + self.batches[1])
+        self.assertEqual(self._get_tweets(), expected)
+
+        with open(self.archive.get_raw_path(), "rb") as f:
+            finished = f.read()
+
+        # A duplicate final batch has nothing new to add
+        self._finalise([])
+        with open(self.archive.get_raw_path(), "rb") as f:
+            self.assertEqual(f.read(), finished)
+        self.assertIsNotNone(self.archive.get_block_index())
+
+        # A late one is added to what's already there
+        self._finalise(self.batches[2:])
+        expected = sorted(expected + self._get_ids(self.batches[2]))
+        self.assertEqual(self._get_tweets(), expected)
+        self.assertIsNotNone(self.archive.get_block_index())
+        self.assertEqual(
+            os.listdir(os.path.dirname(self.archive.get_raw_path())),
+            [os.path.basename(self.archive.get_raw_path()),
+             os.path.basename(self.archive.get_index_path())]
+        )
+
+    def _finalise(self, batches):
+        for tweets in batches:
+            raw.RawAggregator(self.archive).collect(tweets)
+        raw.RawAggregator(self.archive).finalise()
+
+    def _get_tweets(self):
+        """
+        The ids of everything in the archive, read via the block index.
+        """
+        since = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+        return sorted(
+            json.loads(_)["id"] for _ in self.archive.get_tweets(since=since))
+
+    @staticmethod
+    def _get_ids(tweets):
+        return sorted(_.data["id"] for _ in tweets)
+
+
+class ReapTestCase(TestCase):
+
+    def setUp(self):
+
+        self.now = timezone.now()
+        self.archive = Archive.objects.create(
+            query="#test", started=self.now, stopped=self.now)
+
+        for task, method in ((tasks.reap, "apply_async"),
+                             (tasks.finalise, "delay")):
+            patcher = mock.patch.object(task, method)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_queued_segments_survive(self):
+        """
+        Only segments that were claimed too long ago are dead.  One that's
+        been sitting in a backlog just as long is still waiting its turn.
+        """
+
+        long_ago = self.now - datetime.timedelta(seconds=SEGMENT_TIMEOUT * 2)
+
+        queued = self._create_segment(start_time=long_ago)
+        running = self._create_segment(start_time=self.now)
+        dead = self._create_segment(start_time=long_ago, claim_time=long_ago)
+        lost = self._create_segment(
+            start_time=self.now - datetime.timedelta(
+                seconds=SEGMENT_QUEUE_TIMEOUT * 2)
+        )
+
+        tasks.reap(self.archive.pk)
+
+        for segment, is_open in ((queued, True), (running, True),
+                                 (dead, False), (lost, False)):
+            segment.refresh_from_db()
+            self.assertEqual(segment.stop_time is None, is_open)
+
+        tasks.reap.apply_async.assert_called_once_with(
+            (self.archive.pk,), countdown=SEGMENT_TIMEOUT)
+        tasks.finalise.delay.assert_not_called()
+
+    def test_late_batches_are_collected(self):
+        """
+        A batch whose segment was reaped before it was claimed is still
+        collected, and the segment reopened as final so that closing it rolls
+        the archive up again.  One that was already claimed is a duplicate.
+        """
+
+        reaped = self._create_segment(stop_time=self.now)
+        claimed = self._create_segment(
+            claim_time=self.now, stop_time=self.now)
+
+        with mock.patch.object(
+                tasks.RawAggregator, "restore_cache") as restore_cache:
+            segment = tasks._open_segment(
+                self.archive, ArchiveSegment.TYPE_RAW, reaped.pk, False)
+            self.assertIsNone(tasks._open_segment(
+                self.archive, ArchiveSegment.TYPE_RAW, claimed.pk, False))
+
+        restore_cache.assert_called_once_with()
+        self.assertEqual(segment.pk, reaped.pk)
+        self.assertIsNone(segment.stop_time)
+        self.assertIsNotNone(segment.claim_time)
+        self.assertTrue(segment.is_final)
+
+        tasks._close_segment(segment)
+        tasks.finalise.delay.assert_called_once_with(
+            self.archive.pk, ArchiveSegment.TYPE_RAW)
+
+    def _create_segment(self, **kwargs):
+        return ArchiveSegment.objects.create(
+            archive=self.archive, type=ArchiveSegment.TYPE_RAW, **kwargs)
+
+
+class ReplayJournalTestCase(TestCase):
+
+    def setUp(self):
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        now = timezone.now()
+        self.archive = Archive.objects.create(
+            query="#test",
+            started=now,
+            stopped=now + datetime.timedelta(days=1)
+        )
+
+        self.path = os.path.join(directory, "00000000000000001-00000000.fjson")
+
+        patchers = (
+            mock.patch.object(journal, "get_unacknowledged", return_value={
+                self.archive.pk: [self.path]}),
+            mock.patch.object(journal, "remove_empty"),
+            mock.patch.object(AlbatrossListener, "dispatch"),
+        )
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_empty_batch_with_segments_is_dispatched(self):
+        """
+        If we died before a whole line made it into the journal, there's
+        nothing to collect, but the segments that were opened for the batch
+        still need a task to close them.
+        """
+
+        segment_ids = {
+            class_name: ArchiveSegment.objects.create(
+                archive=self.archive, type=class_name).pk
+            for class_name, _ in ArchiveSegment.TYPES
+        }
+
+        with open(self.path, "wb") as f:
+            f.write(b'{"id":')
+        journal.record_segments(self.path, segment_ids)
+
+        Collector.__new__(Collector)._replay_journal()
+
+        AlbatrossListener.dispatch.assert_called_once_with(
+            self.archive,
+            [],
+            is_final=False,
+            segment_ids=segment_ids,
+            journal_segment=self.path
+        )
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_empty_batch_without_segments_is_dropped(self):
+
+        open(self.path, "wb").close()
+
+        Collector.__new__(Collector)._replay_journal()
+
+        AlbatrossListener.dispatch.assert_not_called()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class StatisticsAggregatorTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.aggregator = StatisticsAggregator(
+            Archive(pk=1, query="#benchmark", started=timezone.now()))
+
+    def test_count_column_keeps_first_seen_order(self):
+
+        column = ["es", "en", "ja", "en", "und", "es", "fr", "en"]
+
+        expected = collections.defaultdict(int)
+        for value in column:
+            expected[value] += 1
+
+        counter = collections.defaultdict(int)
+        keys, ids = self.aggregator._count_column(counter, column)
+
+        self.assertEqual(list(counter.items()), list(expected.items()))
+        self.assertEqual(keys, ["es", "en", "ja", "und", "fr"])
+        self.assertEqual([keys[_] for _ in ids], column)
+
+    def test_aggregate_matches_counting_one_at_a_time(self):
+        """
+        The counts used to be made a tweet at a time, and as
+        ._simplify_statistic() is sensitive to the order of its input, the
+        distilled output has to be the same as it was then.
+        """
+
+        tweets = normalise(TweetGenerator(seed=3).tweets(12500))
+
+        aggregate = self.aggregator.aggregate(tweets)
+
+        expected = copy.deepcopy(aggregate)
+        for key in ("hours", "languages"):
+            expected[key] = collections.defaultdict(int)
+        expected["countries"]["complete"] = collections.defaultdict(int)
+        for tweet in tweets:
+            expected["hours"][tweet.hour] += 1
+            expected["languages"][tweet.language] += 1
+            place = tweet.data["place"]
+            if place and place.get("country_code"):
+                country = place["country_code"].lower()
+                expected["countries"]["complete"][country] += 1
+
+        for key in ("hours", "languages"):
+            self.assertEqual(
+                list(aggregate[key].items()), list(expected[key].items()))
+        self.assertEqual(
+            list(aggregate["countries"]["complete"].items()),
+            list(expected["countries"]["complete"].items())
+        )
+
+        self.assertEqual(
+            self.aggregator.distil(copy.deepcopy(aggregate)),
+            self.aggregator.distil(expected)
+        )
@@ -0,0 +1,173 @@
+"""
+The bits of a tweet the aggregators care about, worked out once per tweet
+rather than once per aggregator.
+"""
+
+import calendar
+import functools
+import time
+
+TWITTER_TIME_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
+HOUR_FORMAT = "%Y-%m-%dT%H:00:00+0000"
+
+MONTHS = {
+    "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+    "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12,
+}
+
+
+class NormalisedTweet:
+    """
+    A lightweight, read-only view of a tweet.  Retweets and quotes have their
+    text mangled (a prefixed `RT `, a suffixed `...`), so anything to do with
+    the content of a tweet comes from the tweet at the bottom of the
+    retweet/quote chain, which we only walk the once.  The original
+    dictionary is still available as ``.data`` for everything else.
+    """
+
+    __slots__ = (
+        "data",
+        "id",
+        "timestamp",
+        "hour",
+        "user_id",
+        "screen_name",
+        "language",
+        "text",
+        "lower_text",
+        "original_user",
+        "url",
+        "entities",
+        "hashtags",
+        "mentions",
+    )
+
+    def __init__(self, data):
+
+        origin = get_origin(data)
+
+        self.data = data
+        self.id = data["id"]
+        self.timestamp, self.hour = get_time(data)
+        self.user_id = data["user"].get("id")
+        self.screen_name = data["user"]["screen_name"]
+        self.language = get_language(data)
+        self.text = origin["text"]
+        self.lower_text = self.text.lower()
+        self.original_user = origin["user"]["screen_name"]
+        self.url = _get_url(origin)
+
+        self.entities = data.get("entities") or {}
+        self.hashtags = [
+            _["text"].lower() for _ in self.entities.get("hashtags", ())]
+        self.mentions = [
+            _["screen_name"] for _ in self.entities.get("user_mentions", ())]
+
+    def __repr__(self):
+        return f"<NormalisedTweet {self.id}>"
+
+
+def normalise(tweets):
+    """
+    Accept a list of tweets as either dictionaries or NormalisedTweets and
+    return a list of NormalisedTweets.
+    """
+    return [
+        _ if isinstance(_, NormalisedTweet) else NormalisedTweet(_)
+        for _ in tweets
+    ]
+
+
+def get_origin(tweet):
+    """
+    Follow a retweet or quote down to the tweet it's based on.
+    """
+
+    while True:
+        if "retweeted_status" in tweet:
+            tweet = tweet["retweeted_status"]
+        elif "quoted_status" in tweet:
+            tweet = tweet["quoted_status"]
+        else:
+            return tweet
+
+
+def get_language(tweet):
+    """
+    Twitter has a very strange way of identifying languages
+    """
+
+    r = tweet.get("lang") or tweet["user"].get("lang")
+
+    if not r or r in ("in", "enen", "enes", "fil"):
+        r = "und"
+
+    r = r.lower()
+    if r in ("en-gb",):
+        r = "en"
+    if r in ("zh-cn",):
+        r = "zh"
+
+    return r
+
+
+def get_time(tweet):
+    """
+    Return the time of a tweet as (epoch seconds, hour key), where the hour
+    key is what the statistics use for the hours chart.  Tweets off the
+    stream come with ``timestamp_ms``, which is much cheaper to work with
+    than ``created_at``, but tweets from the REST API (backfill) don't.
+    """
+
+    if "timestamp_ms" in tweet:
+        timestamp = int(tweet["timestamp_ms"]) // 1000
+        return timestamp, _get_hour(timestamp // 3600)
+
+    return _parse_created_at(tweet["created_at"])
+
+
+def get_timestamp(tweet):
+    return get_time(tweet)[0]
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_hour(hours):
+    return time.strftime(HOUR_FORMAT, time.gmtime(hours * 3600))
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_created_at(created_at):
+    """
+    A parser for exactly one format, "Wed Oct 10 20:19:24 +0000 2018",
+    which is all Twitter ever gives us.  Tweets in a batch tend to share
+    their seconds, so the cache takes care of a good share of them.
+    """
+
+    try:
+        if not created_at[19:26] == " +0000 ":
+            raise ValueError()
+        year = int(created_at[26:30])
+        month = MONTHS[created_at[4:7]]
+        day = int(created_at[8:10])
+        hour = int(created_at[11:13])
+        minute = int(created_at[14:16])
+        second = int(created_at[17:19])
+    except (KeyError, ValueError):
+        # Not quite what we expected, so we let strptime sort it out
+        parsed = time.strptime(created_at, TWITTER_TIME_FORMAT)
+        year, month, day, hour, minute, second = parsed[:6]
+
+    timestamp = calendar.timegm((year, month, day, hour, minute, second))
+
+    return timestamp, f"{year:04}-{month:02}-{day:02}T{hour:02}:00:00+0000"
+
+
+def get_url(tweet):
+    return _get_url(get_origin(tweet))
+
+
+def _get_url(tweet):
+    return "https://twitter.com/{}/status/{}".format(
+        tweet["user"]["screen_name"],
+        tweet["id"]
+    )
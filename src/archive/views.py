@@ -1,22 +1,35 @@
 import functools
-import lzma
 from datetime import datetime
 
+from django.conf import settings
 from django.contrib import messages
-from django.http import StreamingHttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
-from django.views.generic import FormView
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.generic import FormView, View
 from rest_framework import generics, permissions
+from rest_framework.exceptions import ValidationError
 from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from albatross import metrics
+
 from .filters import ArchiveFilterSet
 from .forms import ArchiveForm
 from .models import Archive
+from . import compression
 from .aggregators.base import Aggregator
-from .serializers import ArchiveSerializer
+from .aggregators.cloud import CloudAggregator
+from .aggregators.images import ImagesAggregator
+from .aggregators.statistics import StatisticsAggregator
+from .serializers import (
+    ArchiveSegmentSerializer,
+    ArchiveSegmentSummarySerializer,
+    ArchiveSerializer
+)
 
 try:
     import ujson as json
@@ -66,7 +79,91 @@ class ArchiveDetailView(generics.RetrieveAPIView):
     filter_class = ArchiveFilterSet
 
 
-class ArchiveSubsetView(APIView):
+class ArchiveSegmentsView(APIView):
+    """
+    How the work on an archive is going: the instrumentation of the segments
+    still in flight, and the summaries of those that have been finalised.
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
+    renderer_classes = (JSONRenderer, BrowsableAPIRenderer)
+
+    def get(self, request, *args, **kwargs):
+
+        archive = get_object_or_404(Archive, pk=kwargs["pk"])
+
+        return Response({
+            "segments": ArchiveSegmentSerializer(
+                archive.segments.order_by("start_time"), many=True).data,
+            "summaries": ArchiveSegmentSummarySerializer(
+                archive.segment_summaries.all(), many=True).data,
+        })
+
+
+class MetricsView(View):
+    """
+    Everything in albatross.metrics, for Prometheus to scrape.  The age of
+    each running archive's distillations is worked out here at scrape time,
+    as it changes whether anything happens or not.
+    """
+
+    KINDS = ("cloud", "map", "search", "statistics", "images")
+
+    def get(self, request, *args, **kwargs):
+
+        if settings.METRICS_TOKEN:
+            expected = f"Bearer {settings.METRICS_TOKEN}"
+            if not request.META.get("HTTP_AUTHORIZATION") == expected:
+                return HttpResponse(status=401)
+
+        now = timezone.now()
+        archives = Archive.objects.filter(is_running=True).values(
+            "pk", *[f"{kind}_generated" for kind in self.KINDS])
+
+        metrics.DISTILLATION_AGE.clear()
+        for archive in archives:
+            for kind in self.KINDS:
+                generated = archive[f"{kind}_generated"]
+                if generated:
+                    metrics.DISTILLATION_AGE.set(
+                        (now - generated).total_seconds(),
+                        archive=archive["pk"],
+                        kind=kind
+                    )
+
+        return HttpResponse(
+            metrics.registry.render(),
+            content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
+
+
+class TimeWindowMixin:
+    """
+    For views that can be limited to a time window with ``since`` and
+    ``until`` query parameters.
+    """
+
+    def _get_datetime(self, key):
+        """
+        Accept ISO 8601 values for the time window, assuming UTC if no
+        timezone is specified.
+        """
+
+        value = self.request.GET.get(key)
+        if not value:
+            return None
+
+        r = parse_datetime(value)
+        if r is None:
+            raise ValidationError({key: "This must be an ISO 8601 datetime."})
+
+        if timezone.is_naive(r):
+            r = timezone.make_aware(r, timezone.utc)
+
+        return r
+
+
+class ArchiveSubsetView(TimeWindowMixin, APIView):
     """
     Pulls down a subset of a compressed archive.  This can be slow and CPU-
     intensive, so maybe it should go away?  If we remove it though, something
@@ -85,7 +182,9 @@ class ArchiveSubsetView(APIView):
         archive = get_object_or_404(Archive, pk=kwargs.get("pk"))
 
         r = []
-        for tweet_string in archive.get_tweets():
+        for tweet_string in archive.get_tweets(
+                since=self._get_datetime("since"),
+                until=self._get_datetime("until")):
 
             skip = False
 
@@ -155,10 +254,21 @@ class ArchiveSubsetView(APIView):
         return None
 
 
-class ArchiveDistillationView(APIView):
+class ArchiveDistillationView(TimeWindowMixin, APIView):
+    """
+    The distillations are generated over the whole of an archive, but the
+    bucketed ones can be generated for any window with ``since`` and/or
+    ``until``.
+    """
 
     permission_classes = (permissions.AllowAny,)
 
+    BUCKETED = {
+        "statistics": StatisticsAggregator,
+        "cloud": CloudAggregator,
+        "images": ImagesAggregator,
+    }
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.archive = None
@@ -168,8 +278,25 @@ class ArchiveDistillationView(APIView):
         self.archive = get_object_or_404(Archive, pk=kwargs.get("pk"))
 
         kind = kwargs.get("kind")
+
+        since = self._get_datetime("since")
+        until = self._get_datetime("until")
+        if since or until:
+            return self._get_window(kind, since, until)
+
         if kind == "map":
-            with lzma.open(self.archive.get_map_path()) as f:
+            with compression.open(self.archive.get_map_path()) as f:
                 return StreamingHttpResponse(f.readlines())
 
         return StreamingHttpResponse(getattr(self.archive, kind))
+
+    def _get_window(self, kind, since, until):
+
+        if kind not in self.BUCKETED:
+            raise ValidationError(
+                f"Time windows aren't supported for {kind} distillations.")
+
+        aggregator = self.BUCKETED[kind](self.archive)
+
+        return Response(aggregator.distil(aggregator.read_range(
+            since=since, until=until)) or [])